@@ -1,14 +1,27 @@
 from torchvision import transforms
 from pathlib import Path
 from torch.utils.data import Dataset
+import hashlib
 import pandas as pd
 from PIL import Image
 
+from .sample_cache import SampleCache, SampleCacheWriter, ShardShuffleSampler
+
 
 class MainDataset(Dataset):
-    def __init__(self, dataset_path, split='train', transform=None, normalize=False):
+    """NYU image/depth pairs listed in <split>.nyu.
+
+    With cache_path the images and labels are decoded once into a sharded
+    memory-mapped store (built on first use, rebuilt when the split list
+    changes) and later epochs only index into it. Cached samples are the
+    ToTensor output, a custom transform is applied to these tensors.
+    in_memory keeps the shards in RAM, sampler() shuffles shard by shard.
+    """
+    def __init__(self, dataset_path, split='train', transform=None, normalize=False, cache_path=None,
+                 in_memory=False, shard_size=1024):
         super(MainDataset, self).__init__()
         self.normalize = None
+        self.cache = None
 
         self.dataset_path = dataset_path
         self.split = split
@@ -16,22 +29,50 @@ class MainDataset(Dataset):
         path = Path(self.dataset_path) / Path(str(self.split + '.nyu'))
         with open(str(path), 'r') as f:
             self.list_set = f.read()
+        source = hashlib.md5(f'{Path(self.dataset_path).resolve()}\n{self.list_set}'.encode()).hexdigest()
 
         self.list_set = self._splitting(self, set=self.list_set)
 
+        self.transform = transform
         if transform is None:
             self.transform = transforms.Compose([transforms.ToTensor()])
         if normalize:
             self.normalize = transforms.Compose([transforms.Normalize([.485, .456, .406], [.229, .224, .225])])
 
-    def __getitem__(self, indx):
+        if cache_path is not None:
+            cache_path = Path(cache_path) / self.split
+            if not SampleCache.exists(cache_path, source):
+                self.build_cache(cache_path, source, shard_size)
+            self.cache = SampleCache(cache_path, in_memory=in_memory)
+            # cached samples are already tensors
+            self.transform = transform
+
+    def build_cache(self, cache_path, source, shard_size=1024):
+        print(f'Caching {len(self)} {self.split} samples in {cache_path}...')
+        with SampleCacheWriter(cache_path, len(self), shard_size=shard_size, source=source) as writer:
+            for indx in range(len(self)):
+                writer.append(*self.load(indx))
+
+    def sampler(self, seed=0):
+        """Shard-aware shuffling sampler for a cached dataset."""
+        return ShardShuffleSampler(self.cache.shard_offsets if self.cache is not None else [0, len(self)], seed)
+
+    def load(self, indx):
         sample = self.list_set.iloc[indx]
 
         image = Image.open(str(self.dataset_path / Path('nyud') / Path(sample['image'])))
         label = Image.open(str(self.dataset_path / Path('nyud') / Path(sample['label'])))
+        return image, label
+
+    def __getitem__(self, indx):
+        if self.cache is not None:
+            image, label = self.cache.tensors(indx)
+        else:
+            image, label = self.load(indx)
 
-        image = self.transform(image)
-        label = self.transform(label)
+        if self.transform is not None:
+            image = self.transform(image)
+            label = self.transform(label)
 
         if self.normalize is not None:
             image = self.normalize(image)
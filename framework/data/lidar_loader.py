@@ -1,11 +1,26 @@
-from torch import nn
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision import transforms
 from pathlib import Path
-import cv2
+from natsort import natsorted
 from PIL import Image
 
+from framework.lidar.depth_maps import load_depth_map
+from framework.lidar.frames import read_points, read_frame_images, pair_frames
+from framework.lidar.point_store import PointStore
 
-class LidarLoader(nn.Module):
-    def __init__(self, image_path, lidar_data_path):
+
+class LidarLoader(Dataset):
+    """Image and lidar frame pairs of a results folder as tensors.
+
+    Every lidar frame is paired with the image LogWriter recorded for it in
+    velodyne_points/images.txt (see framework.lidar.frames.pair_frames),
+    folders without it are paired by position in natural sort order. Every
+    sample is {'image': (C, H, W) float tensor, 'points': (N, 4) float tensor},
+    use collate_lidar to batch the variable-size clouds.
+    """
+    def __init__(self, image_path, lidar_data_path, transform=None):
         super(LidarLoader, self).__init__()
 
         self.image_path = Path(image_path)
@@ -13,20 +28,102 @@ class LidarLoader(nn.Module):
 
         assert self.image_path.is_dir() and self.lidar_data_path.is_dir(), "The input sting is not paths"
 
-        self.list_image = [x for x in self.image_path.iterdir() if '.bmp' in str(x)]
-        self.list_lidar_data = [x for x in self.lidar_data_path.iterdir() if '.txt' in str(x)]
+        list_image = natsorted([x for x in self.image_path.iterdir() if x.suffix == '.bmp'], key=str)
+
+        # a point store written by LogWriter (velodyne_points/store, next to the data folder)
+        # serves every frame as zero-copy column slices
+        self.point_store = None
+        store_path = next((x for x in [self.lidar_data_path, self.lidar_data_path.parent / 'store']
+                           if PointStore.exists(x)), None)
+        if store_path is not None:
+            self.point_store = PointStore(store_path)
+            list_lidar_data = list(range(self.point_store.num_segments))
+        else:
+            # binary frames written by LogWriter take precedence over the csv dumps
+            suffixes = {x.suffix for x in self.lidar_data_path.iterdir()}
+            self.lidar_format = next((x for x in ['.bin', '.npy', '.txt'] if x in suffixes), '.txt')
+            list_lidar_data = natsorted([x for x in self.lidar_data_path.iterdir()
+                                         if x.suffix == self.lidar_format], key=str)
+
+        frame_images = read_frame_images(self.lidar_data_path.parent)
+        if frame_images is None:
+            assert len(list_image) == len(list_lidar_data), "The input folders contain different number of files"
+        self.list_image, self.list_lidar_data = pair_frames(list_image, list_lidar_data, frame_images)
 
-        assert len(self.list_image) == len(self.list_lidar_data), "The input folders contain different number of files"
+        self.transform = transform if transform is not None else transforms.Compose([transforms.ToTensor()])
 
+    def __len__(self):
+        return len(self.list_image)
 
     def __getitem__(self, item):
-        img = Image.open(str(self.list_image[item]))
+        image = self.transform(Image.open(str(self.list_image[item])))
+        if self.point_store is not None:
+            points = self.point_store.points(self.list_lidar_data[item])
+        else:
+            # memory-mapped .npy frames are read-only, torch needs a writable array
+            points = np.require(read_points(self.list_lidar_data[item]), requirements='W')
+        return {'image': image, 'points': torch.from_numpy(points)}
+
+
+def collate_lidar(batch, mode='pad'):
+    """Batch LidarLoader samples with clouds of different sizes.
+
+    mode='pad' zero-pads the clouds to (B, N_max, 4) and adds a (B, N_max)
+    boolean 'mask' of the real points, mode='pack' concatenates them to
+    (sum N, 4) and adds the 'batch_index' of every point. Both add the
+    'num_points' of every sample. Use functools.partial(collate_lidar, mode='pack')
+    as collate_fn for the packed layout.
+    """
+    images = torch.stack([x['image'] for x in batch])
+    clouds = [x['points'] for x in batch]
+    num_points = torch.tensor([len(x) for x in clouds], dtype=torch.long)
+
+    if mode == 'pack':
+        return {'image': images, 'points': torch.cat(clouds), 'num_points': num_points,
+                'batch_index': torch.repeat_interleave(torch.arange(len(clouds)), num_points)}
+    if mode != 'pad':
+        raise ValueError(f'Unknown collate mode {mode}')
+
+    points = clouds[0].new_zeros((len(clouds), int(num_points.max()), clouds[0].shape[1]))
+    mask = torch.zeros(points.shape[:2], dtype=torch.bool)
+    for i, cloud in enumerate(clouds):
+        points[i, :len(cloud)] = cloud
+        mask[i, :len(cloud)] = True
+    return {'image': images, 'points': points, 'mask': mask, 'num_points': num_points}
+
+
+class LidarDepthDataset(Dataset):
+    """Images of a results folder with the sparse lidar depth maps of DepthMapGenerator as labels.
+
+    Samples follow MainDataset: {'image': (3, H, W), 'label': (1, H, W) depth
+    in meters, 'mask': (1, H, W) bool of the pixels that carry a lidar point}.
+    Depth maps are matched to the images by name, run DepthMapGenerator on
+    the results folder first.
+    """
+    def __init__(self, results_path, depth_path=None, transform=None, normalize=False):
+        super(LidarDepthDataset, self).__init__()
+        self.normalize = None
+
+        self.results_path = Path(results_path)
+        self.depth_path = self.results_path / 'depth' if depth_path is None else Path(depth_path)
+        images = natsorted([x for x in (self.results_path / 'leftImage' / 'data').iterdir() if x.suffix == '.bmp'],
+                           key=str)
+        self.list_set = [(x, self.depth_path / (x.stem + '.npz')) for x in images]
+        missing = [str(y) for _, y in self.list_set if not y.is_file()]
+        assert not missing, f"{len(missing)} depth maps are missing, run DepthMapGenerator first"
+
+        self.transform = transform if transform is not None else transforms.Compose([transforms.ToTensor()])
+        if normalize:
+            self.normalize = transforms.Compose([transforms.Normalize([.485, .456, .406], [.229, .224, .225])])
+
+    def __len__(self):
+        return len(self.list_set)
 
-        lidar_data = []
-        with open(str(self.list_lidar_data[item]), 'r') as f:
-            for line in f:
-                line = line.replace('[', '').replace(']', '').split(',')
-                line = [float(x.replace(' ', '')) for x in line]
-                lidar_data.append(line)
+    def __getitem__(self, indx):
+        image_path, depth_path = self.list_set[indx]
+        image = self.transform(Image.open(str(image_path)).convert('RGB'))
+        if self.normalize is not None:
+            image = self.normalize(image)
 
-        return img, lidar_data
+        depth, mask = load_depth_map(depth_path)
+        return {'image': image, 'label': torch.from_numpy(depth)[None], 'mask': torch.from_numpy(mask)[None]}
@@ -0,0 +1,191 @@
+import os
+import json
+import shutil
+import warnings
+from pathlib import Path
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def decode(image):
+    """The array ToTensor builds from a PIL image, 16/32-bit integer images are returned as int16/int32."""
+    if image.mode == 'I;16':
+        return np.array(image, np.uint16).view(np.int16)
+    return np.array(image)
+
+
+def to_store(array):
+    """uint8/uint16 version of a decoded array that is kept in the store, and the dtype to restore."""
+    if array.dtype == np.uint8:
+        return array, 'uint8'
+    if array.dtype in (np.int16, np.int32):
+        wide = array.view(np.uint16) if array.dtype == np.int16 else array
+        if array.dtype == np.int32 and (wide.min() < 0 or wide.max() > np.iinfo(np.uint16).max):
+            raise ValueError('Only 8 and 16-bit images can be cached')
+        return wide.astype(np.uint16, copy=False), str(array.dtype)
+    raise ValueError(f'Cannot cache images of type {array.dtype}')
+
+
+def to_tensor(array, dtype):
+    """Same tensor as transforms.ToTensor() of the original image, from a (possibly memory-mapped) store array."""
+    if array.ndim == 2:
+        array = array[:, :, None]
+    if dtype == 'uint8':
+        # the read-only mapping is only read, float() makes the copy
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(np.ascontiguousarray(array)).permute(2, 0, 1).float().div(255)
+    if dtype == 'int16':
+        return torch.from_numpy(np.array(array.view(np.int16).transpose(2, 0, 1)))
+    return torch.from_numpy(np.array(array.transpose(2, 0, 1), dtype=dtype))
+
+
+class SampleCacheWriter:
+    """Write decoded image/label pairs into shards of memory-mappable .npy arrays.
+
+    Every shard is a folder with images.npy (n, H, W[, C]) and labels.npy of
+    uint8 or uint16 data, all samples must have the same shape. The cache is
+    built in a temporary folder and moved into place on close, so an
+    interrupted pass never leaves a half-written cache behind.
+    """
+    def __init__(self, path, num_samples, shard_size=1024, source=None):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        shutil.rmtree(str(self.tmp_path), ignore_errors=True)
+        self.tmp_path.mkdir(parents=True)
+
+        self.num_samples = num_samples
+        self.shard_size = shard_size
+        self.source = source
+        self.meta = {}
+        self.arrays = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.arrays = None
+            shutil.rmtree(str(self.tmp_path), ignore_errors=True)
+
+    def open_shard(self, shard):
+        size = min(self.shard_size, self.num_samples - shard * self.shard_size)
+        path = self.tmp_path / f'shard_{shard:05d}'
+        path.mkdir()
+        self.arrays = {name: np.lib.format.open_memmap(str(path / f'{name}s.npy'), mode='w+',
+                                                       dtype=self.meta[name]['store'],
+                                                       shape=(size,) + tuple(self.meta[name]['shape']))
+                       for name in ('image', 'label')}
+
+    def append(self, image, label):
+        stored = {}
+        for name, array in (('image', decode(image)), ('label', decode(label))):
+            stored[name], dtype = to_store(array)
+            if name not in self.meta:
+                self.meta[name] = {'shape': list(array.shape), 'dtype': dtype, 'store': str(stored[name].dtype)}
+            elif list(array.shape) != self.meta[name]['shape'] or dtype != self.meta[name]['dtype']:
+                raise ValueError(f'{name} {self.count} has shape {array.shape} and type {dtype}, '
+                                 f'the cache needs every sample to look like the first one')
+
+        shard, offset = divmod(self.count, self.shard_size)
+        if offset == 0:
+            self.flush()
+            self.open_shard(shard)
+        self.arrays['image'][offset] = stored['image']
+        self.arrays['label'][offset] = stored['label']
+        self.count += 1
+
+    def flush(self):
+        if self.arrays is not None:
+            for array in self.arrays.values():
+                array.flush()
+            self.arrays = None
+
+    def close(self):
+        self.flush()
+        if self.count != self.num_samples:
+            raise ValueError(f'{self.count} samples written, {self.num_samples} expected')
+        meta = dict(self.meta, num_samples=self.count, shard_size=self.shard_size, source=self.source)
+        with open(str(self.tmp_path / 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if self.path.is_dir():
+            shutil.rmtree(str(self.path))
+        os.replace(str(self.tmp_path), str(self.path))
+        return SampleCache(self.path)
+
+
+class SampleCache:
+    """Decoded samples written by SampleCacheWriter.
+
+    Shards are memory-mapped when first used, with in_memory=True they are
+    read into RAM instead (every DataLoader worker keeps its own copy).
+    """
+    def __init__(self, path, in_memory=False):
+        self.path = Path(path)
+        with open(str(self.path / 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.in_memory = in_memory
+        self.shard_size = self.meta['shard_size']
+        self.num_samples = self.meta['num_samples']
+        self.shards = {}
+
+    @staticmethod
+    def exists(path, source=None):
+        meta_path = Path(path) / 'meta.json'
+        if not meta_path.is_file():
+            return False
+        with open(str(meta_path), 'r') as f:
+            return source is None or json.load(f).get('source') == source
+
+    def __len__(self):
+        return self.num_samples
+
+    @property
+    def shard_offsets(self):
+        return list(range(0, self.num_samples, self.shard_size)) + [self.num_samples]
+
+    def shard(self, indx):
+        if indx not in self.shards:
+            path = self.path / f'shard_{indx:05d}'
+            mmap_mode = None if self.in_memory else 'r'
+            self.shards[indx] = (np.load(str(path / 'images.npy'), mmap_mode=mmap_mode),
+                                 np.load(str(path / 'labels.npy'), mmap_mode=mmap_mode))
+        return self.shards[indx]
+
+    def __getitem__(self, indx):
+        shard, offset = divmod(indx, self.shard_size)
+        images, labels = self.shard(shard)
+        return images[offset], labels[offset]
+
+    def tensors(self, indx):
+        image, label = self[indx]
+        return to_tensor(image, self.meta['image']['dtype']), to_tensor(label, self.meta['label']['dtype'])
+
+
+class ShardShuffleSampler(Sampler):
+    """Shuffle the order of the shards and the samples inside each shard.
+
+    Samples of a shard are read together, so an epoch touches every shard
+    once instead of jumping across the whole memory-mapped cache. Call
+    set_epoch before every epoch for a new order.
+    """
+    def __init__(self, shard_offsets, seed=0):
+        self.shard_offsets = list(shard_offsets)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.shard_offsets[-1]
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        for shard in rng.permutation(len(self.shard_offsets) - 1):
+            start, end = self.shard_offsets[shard], self.shard_offsets[shard + 1]
+            yield from (start + rng.permutation(end - start)).tolist()
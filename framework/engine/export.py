@@ -0,0 +1,72 @@
+# run from the repository root: python -m framework.engine.export checkpoint output [--height H] [--width W]
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+
+from framework.model.base import MainModel
+from framework.engine.tester import load_checkpoint, load_torchscript
+
+
+def export_torchscript(checkpoint_path, output_path, height=480, width=640):
+    """Trace MainModel for (1, 3, height, width) inputs with the BatchNorms folded, freeze and save it.
+
+    optimize_for_inference rewrites the graph with MKLDNN constants that
+    cannot be serialized, so it is left to load_torchscript.
+    Returns the eager model the artifact was exported from, for parity checks.
+    """
+    with torch.device('meta'):
+        model = MainModel(same_size_output=True, pretrained=False)
+    model.load_state_dict(load_checkpoint(checkpoint_path), assign=True)
+    model.eval()
+
+    example = torch.rand(1, 3, height, width)
+    with torch.no_grad():
+        fused = copy.deepcopy(model).fuse()
+        traced = torch.jit.trace(fused, example)
+        frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, str(output_path))
+    return model
+
+
+def parity(eager, scripted, images):
+    """Largest absolute difference between the eager and the exported outputs."""
+    with torch.inference_mode():
+        return max((eager(x) - scripted(x)).abs().max().item() for x in images)
+
+
+def latency(model, image, repeats=20, warmup=3):
+    """Median seconds per forward pass."""
+    times = []
+    with torch.inference_mode():
+        for i in range(warmup + repeats):
+            t = time.perf_counter()
+            model(image)
+            times.append(time.perf_counter() - t)
+    return float(np.median(times[warmup:]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help='state dict checkpoint of MainModel')
+    parser.add_argument('output', type=str, help='path of the TorchScript artifact')
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--repeats', type=int, default=20, help='forward passes of the latency benchmark')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads for the benchmark')
+
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    eager = export_torchscript(args.checkpoint, args.output, args.height, args.width)
+    images = [torch.rand(1, 3, args.height, args.width) for _ in range(3)]
+    eager_time = latency(eager, images[0], args.repeats)
+    print(f'Saved {args.output}, latency {args.height}x{args.width}: eager {eager_time * 1e3:.1f} ms')
+    for optimize in (False, True):
+        scripted = load_torchscript(args.output, optimize=optimize)
+        scripted_time = latency(scripted, images[0], args.repeats)
+        print(f'TorchScript{" + optimize_for_inference" if optimize else ""}: '
+              f'max abs difference to eager {parity(eager, scripted, images):.3e}, '
+              f'{scripted_time * 1e3:.1f} ms, speedup {eager_time / scripted_time:.2f}x')
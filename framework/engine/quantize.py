@@ -0,0 +1,70 @@
+# run from the repository root: python -m framework.engine.quantize checkpoint dataset_path output [--split S]
+import argparse
+import torch
+from torch import nn
+
+from framework.data.dataset import MainDataset
+from framework.model.base import MainModel
+from framework.model.quantization import quantize
+from framework.engine.export import latency
+from framework.engine.tester import load_checkpoint
+
+
+def depth_mse(model, samples):
+    """Mean depth MSE against the labels, the Trainer loss."""
+    loss_function = nn.MSELoss()
+    with torch.inference_mode():
+        return sum(loss_function(model(x['image'][None]), x['label'][None].float()).item()
+                   for x in samples) / len(samples)
+
+
+def output_mse(model, reference, samples):
+    """Mean squared difference between the outputs of two models."""
+    with torch.inference_mode():
+        return sum(((model(x['image'][None]) - reference(x['image'][None])) ** 2).mean().item()
+                   for x in samples) / len(samples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help='state dict checkpoint of MainModel')
+    parser.add_argument('dataset_path', type=str, help='MainDataset folder with <split>.nyu and nyud')
+    parser.add_argument('output', type=str, help='path of the int8 TorchScript artifact, Tester loads it directly')
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--calibration', type=int, default=32, help='images the activation ranges are observed on')
+    parser.add_argument('--evaluation', type=int, default=16, help='further images the MSE is reported on')
+    parser.add_argument('--backend', type=str, default='fbgemm', help='fbgemm (x86) or qnnpack (ARM)')
+    parser.add_argument('--repeats', type=int, default=10, help='forward passes of the latency benchmark')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads for the benchmark')
+
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dataset = MainDataset(args.dataset_path, args.split)
+    calibration = [dataset[i] for i in range(min(args.calibration, len(dataset)))]
+    evaluation = [dataset[i] for i in range(len(calibration), min(len(calibration) + args.evaluation, len(dataset)))]
+    if not evaluation:
+        print('No images left after calibration, evaluating on the calibration images')
+        evaluation = calibration
+
+    state_dict = load_checkpoint(args.checkpoint)
+    model = MainModel(same_size_output=True, pretrained=False)
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    quantized = quantize(state_dict, (x['image'][None] for x in calibration), backend=args.backend)
+    with torch.no_grad():
+        example = evaluation[0]['image'][None]
+        torch.jit.save(torch.jit.freeze(torch.jit.trace(quantized, example)), args.output)
+
+    fp32_mse = depth_mse(model, evaluation)
+    int8_mse = depth_mse(quantized, evaluation)
+    print(f'Saved {args.output}, {len(calibration)} calibration and {len(evaluation)} evaluation images')
+    print(f'Depth MSE: fp32 {fp32_mse:.6f}, int8 {int8_mse:.6f}, delta {int8_mse - fp32_mse:+.6f}, '
+          f'int8 vs fp32 output MSE {output_mse(quantized, model, evaluation):.6f}')
+
+    fp32_time = latency(model, example, args.repeats)
+    int8_time = latency(quantized, example, args.repeats)
+    print(f'Latency {example.shape[2]}x{example.shape[3]}: fp32 {fp32_time * 1e3:.1f} ms, '
+          f'int8 {int8_time * 1e3:.1f} ms, speedup {fp32_time / int8_time:.2f}x')
@@ -1,11 +1,14 @@
+import os
+import zipfile
 import torch
 import torchvision
 import json
 import cv2
 from torchvision import transforms
-from PIL import Image
 from torch import nn
 from torch.utils.data import DataLoader
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import time
 import numpy as np
 import matplotlib.pyplot as plt
@@ -23,14 +26,40 @@ class Tester:
         self.log_path = log_path
         self.weigths_path = model_weigths_path
 
-        sizes = get_size_from_backbone(ex_img_path)
-
-        self.model = MainModel(size=sizes, same_size_output=True)
+        # the FPN head sizes its upsampling at runtime, one model serves every resolution
+        self.startup_times = {}
+        t = time.perf_counter()
+        if self.weigths_path is not None and is_torchscript(self.weigths_path):
+            # frozen artifact of framework.engine.export, inference only
+            self.model = load_torchscript(self.weigths_path, self.device)
+            self.startup_times['load TorchScript'] = time.perf_counter() - t
+            t = time.perf_counter()
+        elif self.weigths_path is not None and os.path.isfile(self.weigths_path):
+            # the checkpoint provides every tensor: build the skeleton on the meta device, without
+            # allocation, initialisation or the ImageNet download, and adopt the loaded tensors
+            with torch.device('meta'):
+                self.model = MainModel(same_size_output=True, pretrained=False)
+            self.startup_times['build'] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            state_dict = load_checkpoint(self.weigths_path, self.device)
+            self.startup_times['load checkpoint'] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            self.model.load_state_dict(state_dict, assign=True)
+            self.model.eval()
+        else:
+            self.model = MainModel(same_size_output=True)
+            self.startup_times['build'] = time.perf_counter() - t
+            t = time.perf_counter()
         self.model = self.model.to(self.device)
+        self.startup_times['to device'] = time.perf_counter() - t
+        print('Startup: ' + ', '.join(f'{key} {value * 1e3:.1f} ms' for key, value in self.startup_times.items()))
 
         self.optimizer = None
         self.detach = detach
         if not self.detach:
+            assert isinstance(self.model, MainModel), "Exported models cannot be trained"
             self.optimizer = torch.optim.Adam([{'params': self.model.depthhead.parameters(), 'lr': lr},
                                                {'params': self.model.head.parameters(), 'lr': lr},
                                                {'params': self.model.backbone.parameters(), 'lr': lr * 1e-2}], lr=lr)
@@ -56,42 +85,97 @@ class Tester:
 
         print('Time: ', time.clock() - tt)
 
-    def update_model(self, image_path):
-        sizes = get_size_from_backbone(image_path)
-        print(sizes)
-        self.model = MainModel(size=sizes, same_size_output=True)
-        self.model.load_state_dict(torch.load(self.weigths_path, map_location=torch.device('cpu')))
+    def update_model(self, image_path=None):
+        """Load the checkpoint weights, image_path is no longer needed since the model is not resized."""
+        if is_torchscript(self.weigths_path):
+            self.model = load_torchscript(self.weigths_path, self.device)
+        else:
+            self.model.load_state_dict(load_checkpoint(self.weigths_path, self.device))
         self.model.eval()
 
     def test_sample(self, image_path, img_save_path=None):
 
-        sample = cv2.imread(image_path, cv2.COLOR_BGR2RGB)
-        input_transform = torchvision.transforms.Compose([transforms.ToTensor()])
-
-        img = input_transform(sample)
-        t = time.clock()
+        img = read_image(image_path)
+        t = time.perf_counter()
         out = self.model(img[None, :, :, :]).detach().numpy()[0][0] * 255 * 2
-        print(f'Time: {time.clock() - t}')
+        print(f'Time: {time.perf_counter() - t}')
 
         if img_save_path is not None and type(img_save_path) == str:
             cv2.imwrite(img_save_path, out)
 
-
-def get_size_from_backbone(img_path):
-    sizes = []
-
-    model = MainModel(size=[0, 0, 0, 0])
-
+    def infer_batch(self, images):
+        """Depth maps (N, H, W) of a list of (3, H, W) tensors of one shape, run as a single batch."""
+        self.model.eval()
+        with torch.inference_mode():
+            out = self.model(torch.stack(images).to(self.device))
+        return out[:, 0].cpu().numpy()
+
+    def test_files(self, image_paths, img_save_paths, batch_size=8, workers=2):
+        """test_sample for many files, with frames grouped by shape into batches.
+
+        Images are decoded ahead on worker threads and results are written
+        on them, so the model does not wait for the disk. A batch runs as
+        soon as batch_size frames of one shape are waiting, the rest at the end.
+        """
+        t = time.perf_counter()
+        buckets = {}
+        with ThreadPoolExecutor(max_workers=workers) as readers, ThreadPoolExecutor(max_workers=workers) as writers:
+            def run(shape):
+                paths, images = zip(*buckets.pop(shape))
+                for path, out in zip(paths, self.infer_batch(list(images))):
+                    writers.submit(cv2.imwrite, path, out * 255 * 2)
+
+            def add(save_path, future):
+                img = future.result()
+                shape = tuple(img.shape[1:])
+                buckets.setdefault(shape, []).append((save_path, img))
+                if len(buckets[shape]) == batch_size:
+                    run(shape)
+
+            # decode at most two batches ahead
+            pending = deque()
+            for image_path, save_path in zip(image_paths, img_save_paths):
+                pending.append((save_path, readers.submit(read_image, image_path)))
+                if len(pending) == 2 * batch_size:
+                    add(*pending.popleft())
+            while pending:
+                add(*pending.popleft())
+            for shape in list(buckets):
+                run(shape)
+        print(f'Time: {time.perf_counter() - t}')
+
+
+def load_checkpoint(path, device='cpu'):
+    """State dict of a checkpoint, memory-mapped so only the pages that are used get read.
+
+    Checkpoints in the legacy (pre zip) format cannot be mapped and are read completely.
+    """
+    try:
+        return torch.load(path, map_location=device, mmap=True, weights_only=True)
+    except RuntimeError:
+        return torch.load(path, map_location=device)
+
+
+def is_torchscript(path):
+    """True for an archive written by torch.jit.save, False for a state dict checkpoint."""
+    if not zipfile.is_zipfile(str(path)):
+        return False
+    with zipfile.ZipFile(str(path)) as archive:
+        return any(name.endswith('/constants.pkl') for name in archive.namelist())
+
+
+def load_torchscript(path, device='cpu', optimize=False):
+    """Frozen model written by framework.engine.export or framework.engine.quantize.
+
+    optimize applies torch.jit.optimize_for_inference (MKLDNN layouts), which
+    pays off with several threads but can be slower on a single core.
+    """
+    model = torch.jit.load(str(path), map_location=device)
+    return torch.jit.optimize_for_inference(model) if optimize else model
+
+
+def read_image(image_path):
+    sample = cv2.imread(image_path, cv2.COLOR_BGR2RGB)
     input_transform = torchvision.transforms.Compose([transforms.ToTensor()])
-    image = Image.open(img_path)
-    img = input_transform(image)
-
-    c1, c2, c3, c4 = model.backbone.get_features(img[None, :, :, :])
-
-    sizes.append(img.shape[1:3])
-    sizes.append(c1.shape[2:4])
-    sizes.append(c2.shape[2:4])
-    sizes.append(c3.shape[2:4])
-    sizes.append(c4.shape[2:4])
+    return input_transform(sample)
 
-    return sizes
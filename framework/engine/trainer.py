@@ -1,35 +1,139 @@
+import time
+from collections import defaultdict
+from pathlib import Path
 import torch
 from torch import nn
-from torchvision import transforms
-from model.base import ResNetBackbone, FPNHead, MainModel
-from PIL import Image
-from data.dataset import MainDataset
 from torch.utils.data import DataLoader
 
+from framework.utils.utils import logging
+
+
+class Trainer:
+    """Per-batch training loop for MainModel.
+
+    Batches come from a multi-worker DataLoader with pinned memory and
+    persistent workers. Gradients are accumulated over accumulation_steps
+    batches before every optimizer step. Samples with a 'mask' (sparse lidar
+    depth) only contribute their valid pixels to the loss. The mean time
+    spent waiting for data, in forward, backward and the optimizer step is
+    reported every log_every steps, and the model weights are saved as
+    checkpoint_epoch_<n>.pth every checkpoint_every epochs.
+
+    Not an nn.Module: its `training` flag would shadow the training method.
+    """
+    def __init__(self, model, dataset, optimizer, device, batch_size=1, loss_function=None, num_workers=0,
+                 accumulation_steps=1, channels_last=False, num_threads=None, sampler=None, checkpoint_path=None,
+                 checkpoint_every=1, log_every=10, log_path=None):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
 
-class Trainer(nn.Module):
-    def __init__(self, model, dataset, optimizer, device, batch_size=1):
-        super(Trainer, self).__init__()
         self.dataset = dataset
         self.model = model
-        self.device = device
-        if self.device:
-            self.model = self.model.to(self.device)
+        self.device = torch.device(device if device else 'cpu')
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model = self.model.to(self.device, memory_format=self.memory_format)
 
         self.batch_size = batch_size
-        self.device = device
-        self.dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=True)
+        self.dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=sampler is None,
+                                     sampler=sampler, num_workers=num_workers,
+                                     pin_memory=self.device.type == 'cuda', persistent_workers=num_workers > 0)
 
         self.optimizer = optimizer
+        self.loss_function = loss_function if loss_function is not None else nn.MSELoss()
+        self.accumulation_steps = accumulation_steps
+
+        self.checkpoint_path = Path(checkpoint_path) if checkpoint_path is not None else None
+        self.checkpoint_every = checkpoint_every
+        self.log_every = log_every
+        self.log_path = log_path
+        self.step = 0
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def compute_loss(self, batch_sample, output):
+        label = batch_sample['label'].to(self.device, non_blocking=True).float()
+        if 'mask' in batch_sample:
+            mask = batch_sample['mask'].to(self.device, non_blocking=True)
+            return self.loss_function(output[mask], label[mask])
+        return self.loss_function(output, label)
+
+    def report(self, message):
+        print(message)
+        if self.log_path is not None:
+            logging(self.log_path, message=message + '\n')
 
     def training(self, epoch):
+        self.model.train()
+        if hasattr(self.dataloader.sampler, 'set_epoch'):
+            self.dataloader.sampler.set_epoch(epoch)
+        self.optimizer.zero_grad(set_to_none=True)
+        timing = defaultdict(float)
         epoch_loss = 0
-        self.optimizer.zero_grad()
-        for indx, batch_sample in enumerate(DataLoader):
-            output = self.model(batch_sample['image'])
-            epoch_loss += self.loss_function(batch_sample['label'], output)
+        window_loss = 0
+        num_batches = 0
+
+        tick = time.perf_counter()
+        for indx, batch_sample in enumerate(self.dataloader):
+            image = batch_sample['image'].to(self.device, non_blocking=True, memory_format=self.memory_format)
+            timing['data'] += time.perf_counter() - tick
+
+            tick = time.perf_counter()
+            output = self.model(image)
+            loss = self.compute_loss(batch_sample, output)
+            self.synchronize()
+            timing['forward'] += time.perf_counter() - tick
+
+            tick = time.perf_counter()
+            (loss / self.accumulation_steps).backward()
+            self.synchronize()
+            timing['backward'] += time.perf_counter() - tick
+
+            tick = time.perf_counter()
+            last_batch = indx + 1 == len(self.dataloader)
+            if (indx + 1) % self.accumulation_steps == 0 or last_batch:
+                self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
+                self.step += 1
+            self.synchronize()
+            timing['optimizer'] += time.perf_counter() - tick
+
+            loss = loss.item()
+            epoch_loss += loss
+            window_loss += loss
+            num_batches += 1
+            if num_batches % self.log_every == 0 or last_batch:
+                batches = num_batches % self.log_every or self.log_every
+                times = ', '.join(f'{key} {value / batches * 1e3:.1f} ms' for key, value in timing.items())
+                self.report(f'Epoch: {epoch}, batch: {indx + 1}/{len(self.dataloader)}, '
+                            f'loss: {window_loss / batches:.6f}, per batch: {times}')
+                timing.clear()
+                window_loss = 0
+            tick = time.perf_counter()
+
+        epoch_loss /= max(num_batches, 1)
+        self.report(f'Epoch: {epoch}, loss: {epoch_loss}')
+        return epoch_loss
+
+    def fit(self, epochs, start_epoch=0):
+        for epoch in range(start_epoch, start_epoch + epochs):
+            self.training(epoch)
+            if self.checkpoint_path is not None and (epoch + 1) % self.checkpoint_every == 0:
+                self.save_checkpoint(epoch)
 
-        epoch_loss.backward()
-        self.optimizer.step()
+    def save_checkpoint(self, epoch):
+        """Model weights as checkpoint_epoch_<epoch>.pth (what Tester loads) plus the optimizer state for resuming."""
+        self.checkpoint_path.mkdir(parents=True, exist_ok=True)
+        torch.save(self.model.state_dict(), str(self.checkpoint_path / f'checkpoint_epoch_{epoch}.pth'))
+        torch.save({'epoch': epoch, 'step': self.step, 'optimizer': self.optimizer.state_dict()},
+                   str(self.checkpoint_path / f'optimizer_epoch_{epoch}.pth'))
 
-        print(f'Epoch: {epoch}, loss:{epoch_loss.detach().cpu()}')
+    def load_checkpoint(self, epoch):
+        """Restore the weights and optimizer state saved for epoch, returns the epoch to continue from."""
+        self.model.load_state_dict(torch.load(str(self.checkpoint_path / f'checkpoint_epoch_{epoch}.pth'),
+                                              map_location=self.device))
+        state = torch.load(str(self.checkpoint_path / f'optimizer_epoch_{epoch}.pth'), map_location=self.device)
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.step = state['step']
+        return state['epoch'] + 1
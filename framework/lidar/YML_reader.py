@@ -1,53 +1,102 @@
 import re
 import gzip
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import yaml
 from pathlib import Path
-import pandas as pd
 import numpy as np
 
 
-from .lidar import PointProcessing
+from .lidar import PointProcessing, SweepBuffer
 from .logger import LogWriter
 
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 class YML_Read:
-    def __init__(self, data_path):
+    """Extract the image/lidar pairs of every YML/pcap capture into a results tree.
+
+    With point_cache set, every pcap is decoded once into a PointStore in that
+    folder (see PointProcessing), so a second run loads the stores instead of
+    decoding the pcaps again. power can be called several times, the frames
+    are on disk when it returns. close (or leaving a `with YML_Read(...)`
+    block) stops the background writer and finalizes the results.
+    """
+    def __init__(self, data_path, point_store=False, results_path=None, link_mode='copy', lidar_format='txt',
+                 point_cache=None):
 
         print('Creating experiment arhitecture...')
+        self.data_path = data_path
+        self.point_store = point_store
+        self.link_mode = link_mode
+        self.lidar_format = lidar_format
+        self.point_cache = point_cache
         self.path = Path(data_path) / 'data'
         self.pcap_path = self.path / 'pcap'
         self.yml_path = self.path / 'yml'
         self.images = self.path / 'frames'
         self.pcap_files = np.sort([x for x in self.pcap_path.glob('*.pcap') if x.is_file()])
         self.yml_files = np.sort([x for x in self.yml_path.glob('*.gz*') if x.is_file()])
-        #self.image_files = [(str(x).split('\\')[-1])[:-4] for x in self.images.glob('*.bmp') if x.is_file()]
-
-        self.image_files = [(str(x).split('/')[-1])[:-4] for x in self.images.glob('*.bmp') if x.is_file()]
 
-        self.processing = PointProcessing(data_path)
-        self.writer = LogWriter(data_path)
+        self.processing = PointProcessing(data_path, spill_path=point_cache)
+        self.writer = LogWriter(data_path, point_store=point_store, results_path=results_path, link_mode=link_mode,
+                                lidar_format=lidar_format)
+        self.image_files = self.writer.image_index
 
-        self.processed_images = []
+        self.processed_images = set()
         self.VideoFlows = []
         self.VideoNumbers = []
         self.time_lidar = None
         self.image_number = 0
-        self.XYZD_info = pd.DataFrame({'X': [], 'Y': [], 'Z': [], 'D': [], 'azimuth': [], 'laser_id': [],
-                                       'first_timestamp': [], 'pcap_num': []})
+        self.sweep = SweepBuffer(azimuth_bin=100)
 
-    def power(self, range_yml=None):
+    def power(self, range_yml=None, workers=1):
+        self.writer.check_open()
         print('Running main loop...')
         if range_yml is None:
             range_yml = np.arange(len(self.yml_files))
+        if workers > 1:
+            self.power_parallel(range_yml, workers)
+            return
+
         for i in range_yml:
             self.image_number = 0
+            # every capture starts from an empty sweep, so captures do not depend on each other
+            self.sweep = SweepBuffer(azimuth_bin=100)
             yml_file = str(self.yml_files[i])
             file_name = (yml_file.split('\\')[-1])[:-3]
 
             self.regular_expression(yml_file=file_name)
             print(f'Reading {file_name} ...')
             self.read_yml(filename=yml_file)
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def power_parallel(self, range_yml, workers):
+        """Extract every YML/pcap pair in its own process.
+
+        Each worker writes a complete results tree under results/parts and the
+        parts are merged in range_yml order, so the output is the same as the
+        serial run.
+        """
+        parts_path = self.writer.results_path / 'parts'
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(extract_part, self.data_path, int(i), parts_path / str(i), self.point_store,
+                                   self.link_mode, self.lidar_format, self.point_cache) for i in range_yml]
+            for i, future in zip(range_yml, futures):
+                future.result()
+                print(f'Merging {self.yml_files[i]} ...')
+                self.writer.merge(parts_path / str(i))
+        shutil.rmtree(str(parts_path), ignore_errors=True)
 
     def regular_expression(self, yml_file):
         mat = re.match(r"(?P<flow>\S+)\.(?P<VideoFlow>\d+)\.(?P<VideoNumber>\d+)\.(?P<info>\S+)\.(?P<type>\d*)",
@@ -57,16 +106,74 @@ class YML_Read:
         self.VideoFlows.append(mat["VideoFlow"])
 
     def read_yml(self, filename):
+        self.image_number = 0
+        print('Shots processing...')
+        for shot in self.iter_shots(filename):
+            self.shot_processing(shot=shot)
+
+    @staticmethod
+    def iter_shots(filename):
+        """Yield the entries of the top-level `shots` sequence one at a time.
+
+        The gzip stream is read line by line and every sequence item is parsed
+        on its own as soon as the next one starts, so only one shot is held in
+        memory and shots are processed while the file is still decompressing.
+        A `shots` value that is not a block sequence (e.g. flow style) falls
+        back to load_shots.
+        """
+        fallback = False
+        with gzip.open(filename, "rt") as file:
+            if not file.readline().startswith("%YAML:1.0"):
+                return
+
+            in_shots = False
+            item_indent = None
+            item = []
+            for line in file:
+                stripped = line.lstrip(' ')
+                if not stripped.strip() or stripped.startswith('#'):
+                    if item:
+                        item.append(line)
+                    continue
+                indent = len(line) - len(stripped)
+
+                if not in_shots:
+                    if indent == 0 and stripped.startswith('shots:'):
+                        in_shots = True
+                        # the sequence starts on the key line, e.g. `shots: [ ... ]`
+                        fallback = bool(stripped[len('shots:'):].split('#', 1)[0].strip())
+                        if fallback:
+                            break
+                    continue
+
+                is_item_start = stripped.startswith('-') and stripped[1:2] in ('', ' ', '\n')
+                if item_indent is None and not is_item_start:
+                    fallback = True
+                    break
+                if item_indent is None:
+                    item_indent = indent
+                elif indent < item_indent or \
+                        (indent == item_indent and not is_item_start) or stripped.startswith(('---', '...')):
+                    break
+
+                if indent == item_indent and is_item_start and item:
+                    yield yaml.load(''.join(item), Loader=YAML_LOADER)[0]
+                    item = []
+                item.append(line)
+
+            if item:
+                yield yaml.load(''.join(item), Loader=YAML_LOADER)[0]
+
+        if fallback:
+            yield from YML_Read.load_shots(filename)
+
+    @staticmethod
+    def load_shots(filename):
+        """The whole `shots` sequence of a YML file, parsed with the rest of the document."""
         with gzip.open(filename, "rt") as file:
             config = file.read()
-            self.image_number = 0
-            if config.startswith("%YAML:1.0"):
-                config = "%YAML 1.1" + str(config[len("%YAML:1.0"):])
-                data = list(yaml.safe_load_all(config))
-
-                print('Shots processing...')
-                for shot in (data[0]['shots']):
-                    self.shot_processing(shot=shot)
+        config = "%YAML 1.1" + config[len("%YAML:1.0"):]
+        return next(yaml.load_all(config, Loader=YAML_LOADER))['shots'] or []
 
     def shot_processing(self, shot):
         for key, value in sorted(shot.items(), reverse=True):
@@ -83,24 +190,21 @@ class YML_Read:
                 #print(True if yaml_img_name not in self.processed_images else False)
                 if yaml_img_name in self.image_files and yaml_img_name not in self.processed_images:
                     print('kek?')
-                    self.processed_images.append(yaml_img_name)
+                    self.processed_images.add(yaml_img_name)
 
                     self.writer.save_images(yaml_img_name=yaml_img_name,
                                             image_time=(leftImage_grabMsec / 1e6 + leftImage_deviceSec))
                     time_lidar = datetime.fromtimestamp(
                         leftImage_grabMsec / 1e6 + leftImage_deviceSec).strftime('%Y-%m-%d_%H_%M_%S.%f')
-                    self.writer.save_lidar_data(time_lidar=time_lidar, df=self.XYZD_info)
+                    self.writer.save_lidar_data(time_lidar=time_lidar, df=self.sweep.snapshot(),
+                                                image_name=yaml_img_name)
                     print('kek!')
 
     def lidar_timestamps_processing(self, last_pacTimeStamp):
         XYZD_info_temp = self.processing.get_all_points_by_timestamp(last_pacTimeStamp,
                                                                      pcap_index=self.VideoNumbers[-1])
 
-        if not XYZD_info_temp.empty:
-            self.XYZD_info = pd.concat([self.XYZD_info, XYZD_info_temp], ignore_index=True)
-            self.XYZD_info['counter'] = self.XYZD_info.duplicated(["azimuth", "laser_id"], keep="last")
-            self.XYZD_info = self.XYZD_info[self.XYZD_info['counter'] == False]
-            self.XYZD_info = self.XYZD_info.drop(['counter'], axis=1)
+        self.sweep.update(XYZD_info_temp)
 
     def camera_timestamps_processing(self, camera_items):
         leftImage_deviceSec = None
@@ -116,3 +220,10 @@ class YML_Read:
             if key_Image.startswith("grabMsec"):
                 leftImage_grabMsec = int(key_Image[len("grabMsec:"):])
         return yaml_img_name, leftImage_deviceSec, leftImage_grabMsec
+
+
+def extract_part(data_path, yml_index, results_path, point_store=False, link_mode='copy', lidar_format='txt',
+                 point_cache=None):
+    with YML_Read(data_path, point_store=point_store, results_path=results_path, link_mode=link_mode,
+                  lidar_format=lidar_format, point_cache=point_cache) as reader:
+        reader.power(range_yml=[yml_index])
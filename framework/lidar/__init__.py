@@ -1,3 +1,5 @@
+from .point_store import *
+from .projection import *
 from .lidar import *
 from .logger import *
 from .YML_reader import *
@@ -0,0 +1,262 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+from scipy.optimize import minimize
+
+from .smi import SMIEvaluator, to_grayscale
+
+
+class SharedFrames:
+    """Lidar/image frames copied once into shared memory.
+
+    Points of all frames are packed into one (N, 4) float64 block with
+    per-frame offsets and every grayscale image gets its own block, so pool
+    workers attach to the arrays instead of receiving pickled copies.
+    """
+    def __init__(self, frames):
+        points = [np.asarray(x, dtype=np.float64)[:, :4] for x, _ in frames]
+        images = [to_grayscale(x) for _, x in frames]
+
+        self.offsets = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in points], out=self.offsets[1:])
+        self.blocks = []
+        self.points_spec = self.share(np.concatenate(points) if points else np.zeros((0, 4)))
+        self.image_specs = [self.share(x) for x in images]
+
+    def share(self, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self.blocks.append(block)
+        return block.name, array.shape, array.dtype.str
+
+    def __len__(self):
+        return len(self.image_specs)
+
+    @property
+    def spec(self):
+        return self.points_spec, self.offsets, self.image_specs
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach(spec, blocks):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+# state of a pool worker, filled by init_worker
+worker_state = {}
+
+
+def init_worker(frames_spec, K, D, image_size):
+    points_spec, offsets, image_specs = frames_spec
+    blocks = []
+    points = attach(points_spec, blocks)
+    worker_state['blocks'] = blocks
+    worker_state['points'] = [points[offsets[i]:offsets[i + 1]] for i in range(len(image_specs))]
+    worker_state['images'] = [attach(x, blocks) for x in image_specs]
+    worker_state['evaluator'] = SMIEvaluator(K, D, image_size)
+
+
+def frame_smi(task):
+    cam_pos, frame = task
+    return worker_state['evaluator'](cam_pos, worker_state['points'][frame], worker_state['images'][frame])
+
+
+class ParallelSMI:
+    """SMI summed over a batch of frames, evaluated on a process pool.
+
+    Every (pose, frame) pair is an independent task, so the 12 perturbed poses
+    of a central-difference gradient and all frames of the batch run
+    concurrently. With workers=1 everything runs in the calling process.
+    """
+    def __init__(self, frames, K, D=None, image_size=(1920, 1080), workers=None):
+        self.frames = SharedFrames(frames)
+        self.workers = workers if workers is not None else os.cpu_count()
+        init_args = (self.frames.spec, K, D, image_size)
+
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=init_args)
+        else:
+            init_worker(*init_args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def map(self, poses):
+        """SMI summed over all frames for every pose in poses."""
+        tasks = [(np.asarray(pose, dtype=np.float64), frame) for pose in poses for frame in range(len(self.frames))]
+        if self.pool is not None:
+            values = list(self.pool.map(frame_smi, tasks, chunksize=max(1, len(tasks) // (4 * self.workers))))
+        else:
+            values = [frame_smi(x) for x in tasks]
+        return np.asarray(values).reshape(len(poses), len(self.frames)).sum(axis=1)
+
+    def __call__(self, cam_pos):
+        return float(self.map([cam_pos])[0])
+
+    def gradient(self, cam_pos, step=0.01):
+        """Central-difference gradient of the summed SMI, all 12 poses evaluated at once."""
+        return self.value_and_gradient(cam_pos, step, with_value=False)[1]
+
+    def value_and_gradient(self, cam_pos, step=0.01, with_value=True):
+        cam_pos = np.asarray(cam_pos, dtype=np.float64)
+        shifts = np.eye(len(cam_pos)) * step
+        poses = list(cam_pos + shifts) + list(cam_pos - shifts)
+        values = self.map(poses + [cam_pos] if with_value else poses)
+        gradient = (values[:len(cam_pos)] - values[len(cam_pos):2 * len(cam_pos)]) / (2 * step)
+        return (float(values[-1]) if with_value else None), gradient
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        else:
+            blocks = worker_state.pop('blocks', [])
+            worker_state.clear()
+            for block in blocks:
+                block.close()
+        self.frames.close()
+
+
+def read_cam_mono(path):
+    """K, D and the calibrated lidar pose cam_pos (None before calibration) of a cam_mono.yml.
+
+    The focal lengths are doubled like in SMI_calculations.read_calib_data,
+    the poses found by ExtrinsicCalibrator are relative to this K.
+    """
+    cam_mono = cv2.FileStorage(str(path), cv2.FILE_STORAGE_READ)
+    K = np.array(cam_mono.getNode("K").mat())
+    K[0, 0] = 2 * K[0, 0]
+    K[1, 1] = 2 * K[1, 1]
+    D = [x[0] for x in np.array(cam_mono.getNode("D").mat())]
+    node = cam_mono.getNode("cam_pos")
+    cam_pos = None if node.empty() else np.array(node.mat()).ravel()
+    cam_mono.release()
+    return K, D, cam_pos
+
+
+def write_cam_pos(path, cam_pos):
+    """Store the calibrated lidar pose as cam_pos in cam_mono.yml, keeping its matrix and scalar nodes."""
+    cam_mono = cv2.FileStorage(str(path), cv2.FILE_STORAGE_READ)
+    nodes = {}
+    for key in cam_mono.root().keys():
+        node = cam_mono.getNode(key)
+        if node.isString():
+            nodes[key] = node.string()
+        elif node.isInt() or node.isReal():
+            nodes[key] = node.real()
+        elif node.mat() is not None:
+            nodes[key] = node.mat()
+    cam_mono.release()
+
+    nodes['cam_pos'] = np.asarray(cam_pos, dtype=np.float64).reshape(-1, 1)
+    cam_mono = cv2.FileStorage(str(path), cv2.FILE_STORAGE_WRITE)
+    for key, value in nodes.items():
+        cam_mono.write(key, value)
+    cam_mono.release()
+
+
+def downsample(gray, factor):
+    """Average factor x factor blocks of a grayscale image."""
+    if factor == 1:
+        return gray
+    h, w = gray.shape[0] // factor * factor, gray.shape[1] // factor * factor
+    blocks = gray[:h, :w].reshape(h // factor, factor, w // factor, factor)
+    return np.round(blocks.mean(axis=(1, 3))).astype(np.uint8)
+
+
+class ExtrinsicCalibrator:
+    """Coarse-to-fine maximisation of the summed SMI over the 6-DoF lidar-camera pose.
+
+    Level l of the pyramid uses images downsampled by 2^l, intrinsics scaled
+    to match and a 1/4^l random subsample of the points. Each level runs
+    L-BFGS on -SMI with the parallel central-difference gradient, starting
+    from the solution of the coarser level, and stops on maxiter or when the
+    relative improvement falls under tol. The search is bounded to
+    +-search_range (radians, meters) around the starting pose, because SMI
+    also grows for poses that project only a handful of points. The last
+    solution is kept, so the next calibrate() call warm starts from it.
+    """
+    def __init__(self, frames, K, D=None, image_size=(1920, 1080), levels=3, step=0.01, tol=1e-6,
+                 max_iter=50, search_range=(0.1, 0.1, 0.1, 0.5, 0.5, 0.5), workers=None, log_path=None, seed=0):
+        self.set_frames(frames)
+        self.K = np.asarray(K, dtype=np.float64)
+        self.D = D
+        self.image_size = image_size
+        self.levels = levels
+        self.step = step
+        self.tol = tol
+        self.max_iter = max_iter
+        self.search_range = np.asarray(search_range, dtype=np.float64)
+        self.workers = workers
+        self.log_path = log_path
+        self.rng = np.random.RandomState(seed)
+
+        self.solution = None
+        self.trace = []
+
+    def set_frames(self, frames):
+        self.frames = [(np.asarray(points, dtype=np.float64)[:, :4], to_grayscale(image)) for points, image in frames]
+
+    def level_frames(self, level):
+        factor = 2 ** level
+        frames = []
+        for points, gray in self.frames:
+            if level:
+                points = points[self.rng.rand(len(points)) < 1.0 / factor ** 2]
+            frames.append((points, downsample(gray, factor)))
+        K = self.K.copy()
+        K[:2] /= factor
+        return frames, K, (self.image_size[0] // factor, self.image_size[1] // factor)
+
+    def log(self, message):
+        print(message)
+        if self.log_path is not None:
+            with open(str(self.log_path), 'a+') as f:
+                f.write(message + '\n')
+
+    def calibrate(self, initial=None):
+        cam_pos = np.asarray(initial if initial is not None else self.solution, dtype=np.float64)
+        self.trace = []
+        start = time.perf_counter()
+        bounds = list(zip(cam_pos - self.search_range, cam_pos + self.search_range))
+
+        for level in reversed(range(self.levels)):
+            frames, K, image_size = self.level_frames(level)
+            step = self.step * 2 ** level
+            with ParallelSMI(frames, K, self.D, image_size, workers=self.workers) as smi:
+                last = {}
+
+                def objective(x):
+                    value, gradient = smi.value_and_gradient(x, step)
+                    last['x'], last['value'] = x.copy(), value
+                    return -value, -gradient
+
+                def callback(x):
+                    value = last['value'] if np.array_equal(last.get('x'), x) else smi(x)
+                    self.trace.append((level, len(self.trace), value, x.copy(), time.perf_counter() - start))
+                    self.log(f'level {level} iter {len(self.trace)}: SMI {value:.6f}, pose {np.round(x, 5).tolist()}')
+
+                result = minimize(objective, cam_pos, jac=True, method='L-BFGS-B', bounds=bounds, callback=callback,
+                                  options={'maxiter': self.max_iter, 'ftol': self.tol})
+            cam_pos = result.x
+            self.log(f'level {level} done: SMI {-result.fun:.6f}, {result.nit} iterations, {result.message}')
+
+        self.solution = cam_pos
+        self.log(f'Calibration finished in {time.perf_counter() - start:.2f} s: {np.round(cam_pos, 5).tolist()}')
+        return cam_pos
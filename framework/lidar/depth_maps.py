@@ -0,0 +1,121 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+from .calibration import read_cam_mono
+from .frames import CalibrationFrames
+from .projection import project_points
+
+
+def sparse_depth_map(points, cam_pos, K, D=None, image_size=(1920, 1080)):
+    """Z-buffered sparse depth map (H, W) float32 and validity mask (H, W) bool of one lidar frame.
+
+    Points are projected in one pass and shifted to array indices like in
+    SMIEvaluator.sample. Where several points hit the same pixel the nearest
+    one is kept, pixels without a point have depth 0 and mask False.
+    """
+    width, height = image_size
+    pixels, depth, valid = project_points(points, cam_pos, K, D, image_size)
+    x = np.trunc(pixels[valid, 0] + width / 2 - 1).astype(np.int64)
+    y = np.trunc(pixels[valid, 1] + height / 2 - 1).astype(np.int64)
+    z = depth[valid]
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    flat, z = y[inside] * width + x[inside], z[inside]
+
+    # sort by pixel, then by depth: the first entry of every pixel is the nearest point
+    order = np.lexsort((z, flat))
+    flat, first = np.unique(flat[order], return_index=True)
+
+    depth_map = np.zeros(height * width, dtype=np.float32)
+    mask = np.zeros(height * width, dtype=bool)
+    depth_map[flat] = z[order][first]
+    mask[flat] = True
+    return depth_map.reshape(height, width), mask.reshape(height, width)
+
+
+# state of a pool worker, filled by init_worker
+worker_state = {}
+
+
+def init_worker(results_path, cam_pos, distortion):
+    frames = CalibrationFrames(results_path, prefetch=0)
+    K, D, stored_pos = read_cam_mono(frames.results_path / 'calib' / 'cam_mono.yml')
+    worker_state['frames'] = frames
+    worker_state['K'] = K
+    worker_state['D'] = D if distortion else None
+    worker_state['cam_pos'] = np.asarray(cam_pos if cam_pos is not None else stored_pos, dtype=np.float64)
+
+
+def depth_task(task):
+    indx, path = task
+    frames = worker_state['frames']
+    image_size = Image.open(str(frames.image_files[indx])).size
+    depth, mask = sparse_depth_map(frames.load_points(indx), worker_state['cam_pos'], worker_state['K'],
+                                   worker_state['D'], image_size)
+    # write under a temporary name, an interrupted run never leaves a truncated cache entry
+    tmp_path = path.with_name(path.stem + '.tmp.npz')
+    np.savez_compressed(str(tmp_path), depth=depth, mask=mask)
+    os.replace(str(tmp_path), str(path))
+    return indx
+
+
+class DepthMapGenerator:
+    """Turn the saved lidar frames of a results tree into sparse depth supervision.
+
+    Every frame is projected with K, D and the calibrated pose cam_pos from
+    results/calib/cam_mono.yml (written by SMI_calculations.read_scv) or with
+    an explicitly given pose. The depth map and mask of a frame are cached as
+    results/depth/<image name>.npz and frames with an up to date cache entry
+    are skipped, the remaining ones run on a process pool.
+    """
+    def __init__(self, results_path, cam_pos=None, distortion=False, output_path=None, workers=None):
+        self.results_path = Path(results_path)
+        self.output_path = self.results_path / 'depth' if output_path is None else Path(output_path)
+        self.calib_file = self.results_path / 'calib' / 'cam_mono.yml'
+        self.cam_pos = cam_pos
+        self.distortion = distortion
+        self.workers = workers if workers is not None else os.cpu_count()
+
+        if cam_pos is None and read_cam_mono(self.calib_file)[2] is None:
+            raise ValueError(f'{self.calib_file} has no cam_pos, run the calibration or pass cam_pos')
+        self.frames = CalibrationFrames(self.results_path, prefetch=0)
+
+    def cache_file(self, indx):
+        return self.output_path / (self.frames.image_files[indx].stem + '.npz')
+
+    def is_cached(self, indx):
+        path = self.cache_file(indx)
+        if not path.is_file():
+            return False
+        if self.frames.point_store is not None:
+            source = self.frames.point_store.path
+        else:
+            source = self.frames.lidar_files[indx]
+        # a new calibration or a rewritten frame makes the entry stale
+        return path.stat().st_mtime >= max(self.calib_file.stat().st_mtime, Path(source).stat().st_mtime)
+
+    def run(self, frame_indices=None, overwrite=False):
+        if frame_indices is None:
+            frame_indices = range(len(self.frames))
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        tasks = [(i, self.cache_file(i)) for i in frame_indices if overwrite or not self.is_cached(i)]
+        print(f'Depth maps: {len(tasks)} to compute, {len(frame_indices) - len(tasks)} cached')
+        init_args = (self.results_path, self.cam_pos, self.distortion)
+
+        if self.workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=init_args) as pool:
+                list(pool.map(depth_task, tasks, chunksize=max(1, len(tasks) // (4 * self.workers))))
+        else:
+            init_worker(*init_args)
+            for task in tasks:
+                depth_task(task)
+            worker_state.clear()
+        return [self.cache_file(i) for i in frame_indices]
+
+
+def load_depth_map(path):
+    """Depth map and mask cached by DepthMapGenerator."""
+    with np.load(str(path)) as data:
+        return data['depth'], data['mask']
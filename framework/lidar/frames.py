@@ -0,0 +1,136 @@
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from natsort import natsorted
+from PIL import Image
+
+from .point_store import PointStore
+
+
+def read_points(path):
+    """(N, 4) float32 x, y, z, reflectance array of one lidar frame written by LogWriter.
+
+    .bin frames are read in one go and .npy frames are memory-mapped (read-only).
+    Text frames are parsed in one vectorized pass, brackets of the old list
+    dumps are dropped and only the first four columns are kept.
+    """
+    path = Path(path)
+    if path.suffix == '.bin':
+        return np.fromfile(str(path), dtype=np.float32).reshape(-1, 4)
+    if path.suffix == '.npy':
+        return np.load(str(path), mmap_mode='r')[:, :4].astype(np.float32, copy=False)
+
+    with open(str(path), 'r') as f:
+        text = f.read().replace('[', '').replace(']', '')
+    return np.loadtxt(io.StringIO(text), delimiter=',', dtype=np.float32, ndmin=2, usecols=range(4))
+
+
+def read_frame_images(lidar_path):
+    """Image name of every saved lidar frame, from the images.txt LogWriter keeps in lidar_path, or None."""
+    path = Path(lidar_path) / 'images.txt'
+    if not path.is_file():
+        return None
+    with open(str(path), 'r') as f:
+        return f.read().splitlines()
+
+
+def pair_frames(image_files, lidar_frames, frame_images=None):
+    """Pair every image with the lidar frame saved for it, returns both lists in image order.
+
+    lidar_frames[i] is the i-th saved frame (a file or a store segment) and
+    frame_images[i] the name of its image, see read_frame_images. Images
+    without a lidar frame are left out. Without the names (e.g. results of an
+    older LogWriter) the lists are paired by position.
+    """
+    if frame_images is None or len(frame_images) != len(lidar_frames):
+        num_pairs = min(len(image_files), len(lidar_frames))
+        return list(image_files[:num_pairs]), list(lidar_frames[:num_pairs])
+
+    by_name = {name: frame for name, frame in zip(frame_images, lidar_frames) if name}
+    images = [x for x in image_files if x.stem in by_name]
+    return images, [by_name[x.stem] for x in images]
+
+
+class CalibrationFrames:
+    """Lazily loaded image/lidar pairs of a results folder.
+
+    Every lidar frame is paired with the image LogWriter recorded for it in
+    velodyne_points/images.txt, older results without it are paired by
+    position in natural sort order. Decoded grayscale images and point arrays
+    are kept in an LRU cache of cache_size frames and reading frame i
+    schedules frames i + 1 .. i + prefetch on a background thread.
+    """
+    def __init__(self, results_path, cache_size=32, prefetch=2):
+        self.results_path = Path(results_path)
+        image_path = self.results_path / 'leftImage' / 'data'
+        lidar_path = self.results_path / 'velodyne_points' / 'data'
+        store_path = self.results_path / 'velodyne_points' / 'store'
+
+        image_files = natsorted([x for x in image_path.glob('*.bmp') if x.is_file()], key=str)
+        self.point_store = PointStore(store_path) if PointStore.exists(store_path) else None
+        if self.point_store is not None:
+            # segment i is lidar frame i + 1, the store is kept in save order
+            lidar_files = list(range(self.point_store.num_segments))
+        else:
+            lidar_files = natsorted([x for x in lidar_path.iterdir()
+                                     if x.suffix in ('.txt', '.csv', '.bin', '.npy')], key=str)
+        self.image_files, self.lidar_files = pair_frames(image_files, lidar_files,
+                                                         read_frame_images(lidar_path.parent))
+        if len(self.image_files) != max(len(image_files), len(lidar_files)):
+            print(f'Warning: {len(image_files)} images and {len(lidar_files)} lidar frames, '
+                  f'using {len(self.image_files)} pairs')
+
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def load_points(self, indx):
+        if self.point_store is not None:
+            return self.point_store.points(self.lidar_files[indx])
+        return read_points(self.lidar_files[indx])
+
+    def load(self, indx):
+        gray = np.asarray(Image.open(str(self.image_files[indx])).convert('L'))
+        return self.load_points(indx), gray
+
+    def __getitem__(self, indx):
+        if indx < 0:
+            indx += len(self)
+        if not 0 <= indx < len(self):
+            raise IndexError(indx)
+
+        with self.lock:
+            frame = self.cache.get(indx)
+            future = self.pending.pop(indx, None)
+        if frame is None:
+            frame = future.result() if future is not None else self.load(indx)
+            with self.lock:
+                self.cache[indx] = frame
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        with self.lock:
+            if indx in self.cache:
+                self.cache.move_to_end(indx)
+
+        window = range(indx + 1, min(indx + 1 + self.prefetch, len(self)))
+        with self.lock:
+            # under random access the earlier prefetches are never read, drop them
+            for i in [x for x in self.pending if x not in window]:
+                self.pending.pop(i).cancel()
+            for i in window:
+                if i not in self.cache and i not in self.pending:
+                    self.pending[i] = self.executor.submit(self.load, i)
+        return frame
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -1,4 +1,8 @@
+import os
+import mmap
 import struct
+import hashlib
+from collections import OrderedDict
 from datetime import datetime
 from distutils.dir_util import copy_tree
 from pathlib import Path
@@ -6,6 +10,24 @@ import shutil
 import numpy as np
 import pandas as pd
 
+from .point_store import PointStore, PointStoreWriter
+
+
+PCAP_GLOBAL_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_SIZE = 16
+UDP_HEADER_SIZE = 42
+VLP16_PACKET_SIZE = 1206
+
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': '<', b'\x4d\x3c\xb2\xa1': '<',
+              b'\xa1\xb2\xc3\xd4': '>', b'\xa1\xb2\x3c\x4d': '>'}
+
+VLP16_BLOCK_DTYPE = np.dtype([('flag', '<u2'), ('azimuth', '<u2'),
+                              ('channels', [('distance', '<u2'), ('reflectivity', 'u1')], (32,))])
+
+# UDP payload of a VLP-16 data packet: 12 firing blocks + timestamp + factory bytes
+VLP16_PACKET_DTYPE = np.dtype([('blocks', VLP16_BLOCK_DTYPE, (12,)),
+                               ('timestamp', '<u4'), ('factory', '<u2')])
+
 
 class PointReader:
     def __init__(self, data_path):
@@ -31,78 +53,274 @@ class PointReader:
 
     def get_pcap_data(self, file_number):
         print('Getting pcap data...')
-        pcap_file = str(self.pcap_files[int(file_number) - 1])
-        pcap_data = open(pcap_file, 'rb').read()
-        pcap_data = pcap_data[24:]
-        for offset in range(0, int(len(pcap_data)), 1264):
-            if (len(pcap_data) - offset) < 1264:
-                break
-
-            ''' current packet 1264 inclide 16 timeinfo '''
-            cur_packet = pcap_data[offset + 16: offset + 16 + 42 + 1200 + 4 + 2]
-
-            cur_data = cur_packet[42:]
-            self.first_timestamp, self.factory = struct.unpack_from("<IH", cur_data, offset=1200)
-            assert hex(self.factory) == '0x2237', 'Error mode: 0x22=VLP-16, 0x37=Strongest Return'
-            seq_index = 0
-            for seq_offset in range(0, 1100, 100):
-                self.seq_processing(cur_data, seq_offset, seq_index, self.first_timestamp, int(file_number) - 1)
+        chunks = list(self.iter_pcap_chunks(file_number))
+        if chunks:
+            self.df = pd.concat(chunks, ignore_index=True)
+        else:
+            self.df = pd.DataFrame(columns=self.df.columns)
         print('End processing pcap file...')
 
-    def seq_processing(self, data, seq_offset, seq_index, first_timestamp, pcap_num):
-        flag, first_azimuth = struct.unpack_from("<HH", data, seq_offset)
-        step_azimuth = 0
-        assert hex(flag) == '0xeeff', 'Flag error'
-        for step in range(2):
-            if step == 0 and seq_index % 2 == 0 and seq_index < 22:
-                flag, third_azimuth = struct.unpack_from("<HH", data, seq_offset + 4 + 3 * 16 * 2)
-                assert hex(flag) == '0xeeff', 'Flag error'
-                if third_azimuth < first_azimuth:
-                    step_azimuth = third_azimuth + self.ROTATION_MAX_UNITS - first_azimuth
-                else:
-                    step_azimuth = third_azimuth - first_azimuth
-
-            arr = struct.unpack_from('<' + "HB" * self.NUM_LASERS, data, seq_offset + 4 + step * 3 * 16)
-
-            for i in range(self.NUM_LASERS):
-                azimuth = first_azimuth + (step_azimuth * (55.296 / 1e6 * step + i * 2.304 / 1e6)) / (2 * 55.296 / 1e6)
-                if azimuth > self.ROTATION_MAX_UNITS:
-                    azimuth -= self.ROTATION_MAX_UNITS
-
-                x, y, z = self.calc_real_val(arr[i * 2], azimuth, i)
-                # azimuth_time = (55.296 / 1e6 * step + i * (2.304 / 1e6)) + first_timestamp
-                new_row = pd.Series(
-                    [x, y, z, arr[i * 2 + 1], round(azimuth * 1.0 / self.azimuth_bin), i, first_timestamp, pcap_num],
-                    index=self.df.columns)
-                self.df = self.df.append(new_row, ignore_index=True)
-            seq_index += 1
-
-    def calc_real_val(self, dis, azimuth, laser_id):
-        r = dis * self.DISTANCE_RESOLUTION
-        omega = self.LASER_ANGLES[laser_id] * np.pi / 180.0
+    def iter_pcap_packets(self, file_number):
+        """Yield the VLP-16 data packets of a pcap file one by one.
+
+        The file is memory-mapped and walked by its record headers, so only the
+        current packet is copied out. Records that are too short to hold a data
+        packet (e.g. position packets) are skipped.
+        """
+        pcap_file = str(self.pcap_files[int(file_number) - 1])
+        with open(pcap_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < PCAP_GLOBAL_HEADER_SIZE:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                assert mm[:4] in PCAP_MAGIC, f'{pcap_file} is not a pcap file'
+                record_header = struct.Struct(PCAP_MAGIC[mm[:4]] + 'IIII')
+
+                offset = PCAP_GLOBAL_HEADER_SIZE
+                while offset + PCAP_RECORD_HEADER_SIZE <= len(mm):
+                    _, _, incl_len, _ = record_header.unpack_from(mm, offset)
+                    offset += PCAP_RECORD_HEADER_SIZE
+                    if offset + incl_len > len(mm):
+                        break
+                    if incl_len >= UDP_HEADER_SIZE + VLP16_PACKET_SIZE:
+                        yield mm[offset + UDP_HEADER_SIZE: offset + UDP_HEADER_SIZE + VLP16_PACKET_SIZE]
+                    offset += incl_len
+
+    def iter_packet_chunks(self, file_number, chunk_packets=1024):
+        """Group the packets of a pcap file into structured arrays of at most chunk_packets packets."""
+        chunk = []
+        for packet in self.iter_pcap_packets(file_number):
+            chunk.append(packet)
+            if len(chunk) == chunk_packets:
+                yield np.frombuffer(b''.join(chunk), dtype=VLP16_PACKET_DTYPE)
+                chunk = []
+        if chunk:
+            yield np.frombuffer(b''.join(chunk), dtype=VLP16_PACKET_DTYPE)
+
+    def iter_pcap_chunks(self, file_number, azimuth_bin=None, chunk_packets=1024):
+        """Decode a pcap file lazily, yielding one points dataframe per chunk_packets packets."""
+        if azimuth_bin is not None and azimuth_bin != self.azimuth_bin:
+            self.azimuth_bin = azimuth_bin
+
+        for packets in self.iter_packet_chunks(file_number, chunk_packets):
+            yield self.decode_packets(packets, int(file_number) - 1)
+
+    def write_point_store(self, file_number, path, chunk_packets=1024):
+        """Decode a pcap file once into a columnar PointStore with one segment per packet.
+
+        Azimuth is stored unbinned, in hundredths of a degree.
+        """
+        print('Writing point store...')
+        with PointStoreWriter(path, azimuth_bin=1, constants={'pcap_num': int(file_number) - 1}) as writer:
+            for packets in self.iter_packet_chunks(file_number, chunk_packets):
+                columns = self.decode_columns(packets)
+                columns['azimuth'] = np.round(columns['azimuth'])
+                writer.append(columns, packets['timestamp'], np.full(len(packets), 12 * 2 * self.NUM_LASERS))
+        return PointStore(path)
+
+    def decode_packets(self, packets, pcap_num):
+        """Decode a structured array of VLP-16 packets into one point per laser return.
+
+        All firing blocks are processed in one batch, the output keeps the
+        packet -> block -> sequence -> laser order of the per-packet parser.
+        """
+        if len(packets) == 0:
+            return pd.DataFrame(columns=self.df.columns)
+
+        columns = self.decode_columns(packets)
+        # integer hundredths first, like the PointStore, so both paths put a return in the same bin
+        columns['azimuth'] = np.round(np.round(columns['azimuth']) / self.azimuth_bin).astype(np.int64)
+        columns['pcap_num'] = np.full(len(columns['X']), pcap_num)
+        return pd.DataFrame(columns)
+
+    def decode_columns(self, packets):
+        """Decode VLP-16 packets into flat column arrays, azimuth is left unbinned."""
+        self.first_timestamp = int(packets['timestamp'][-1])
+        self.factory = int(packets['factory'][-1])
+        assert (packets['factory'] == 0x2237).all(), 'Error mode: 0x22=VLP-16, 0x37=Strongest Return'
+
+        blocks = packets['blocks']
+        assert (blocks['flag'] == 0xeeff).all(), 'Flag error'
+
+        # azimuth of the next block gives the rotation over two firing sequences,
+        # the last block of a packet reuses the step of the previous one
+        first_azimuth = blocks['azimuth'].astype(np.float64)
+        step_azimuth = np.empty_like(first_azimuth)
+        step_azimuth[:, :-1] = np.mod(first_azimuth[:, 1:] - first_azimuth[:, :-1], self.ROTATION_MAX_UNITS)
+        step_azimuth[:, -1] = step_azimuth[:, -2]
+
+        step = np.arange(2).reshape(2, 1)
+        laser_id = np.arange(self.NUM_LASERS).reshape(1, self.NUM_LASERS)
+        firing_offset = 55.296 / 1e6 * step + laser_id * 2.304 / 1e6
+
+        azimuth = first_azimuth[:, :, None, None] + \
+            (step_azimuth[:, :, None, None] * firing_offset) / (2 * 55.296 / 1e6)
+        azimuth = np.where(azimuth > self.ROTATION_MAX_UNITS, azimuth - self.ROTATION_MAX_UNITS, azimuth)
+
+        channels = blocks['channels'].reshape(len(packets), 12, 2, self.NUM_LASERS)
+        r = channels['distance'] * self.DISTANCE_RESOLUTION
+        omega = np.asarray(self.LASER_ANGLES) * np.pi / 180.0
         alpha = (azimuth / 100.0) * (np.pi / 180.0)
-        x = r * np.cos(omega) * np.sin(alpha)
-        y = r * np.cos(omega) * np.cos(alpha)
-        z = r * np.sin(omega)
 
-        return x, y, z
+        timestamps = np.broadcast_to(packets['timestamp'][:, None, None, None], azimuth.shape)
+        return {'X': (r * np.cos(omega) * np.sin(alpha)).ravel(),
+                'Y': (r * np.cos(omega) * np.cos(alpha)).ravel(),
+                'Z': (r * np.sin(omega)).ravel(),
+                'D': channels['reflectivity'].ravel(),
+                'azimuth': azimuth.ravel(),
+                'laser_id': np.broadcast_to(laser_id, azimuth.shape).ravel(),
+                'first_timestamp': timestamps.ravel()}
+
+
+class PointIndex:
+    """Sorted timestamp index over decoded points.
+
+    Points are kept ordered by first_timestamp, so the returns of one packet
+    (or of a timestamp range) are a contiguous slice found by binary search.
+    A secondary (azimuth, timestamp) ordering serves the azimuth filter.
+    """
+    def __init__(self, df):
+        timestamps = df['first_timestamp'].values
+        if not (timestamps[1:] >= timestamps[:-1]).all():
+            df = df.iloc[np.argsort(timestamps, kind='stable')]
+        self.df = df.reset_index(drop=True)
+        self.timestamps = self.df['first_timestamp'].values
+
+        azimuth = self.df['azimuth'].values
+        self.azimuth_order = np.lexsort((self.timestamps, azimuth))
+        self.azimuth_keys = azimuth[self.azimuth_order]
+        self.azimuth_timestamps = self.timestamps[self.azimuth_order]
+
+    def __len__(self):
+        return len(self.df)
+
+    @property
+    def nbytes(self):
+        return int(self.df.memory_usage(index=True).sum()) + self.azimuth_order.nbytes + \
+            self.azimuth_keys.nbytes + self.azimuth_timestamps.nbytes
+
+    def get_by_timestamp(self, timestamp, azimuth=None):
+        return self.get_by_range(timestamp, timestamp, azimuth=azimuth)
+
+    def get_by_range(self, start, end, azimuth=None):
+        """Return the points with start <= first_timestamp <= end."""
+        if azimuth is None:
+            lo = np.searchsorted(self.timestamps, start, side='left')
+            hi = np.searchsorted(self.timestamps, end, side='right')
+            return self.df.iloc[lo:hi]
+
+        lo = np.searchsorted(self.azimuth_keys, azimuth, side='left')
+        hi = np.searchsorted(self.azimuth_keys, azimuth, side='right')
+        timestamps = self.azimuth_timestamps[lo:hi]
+        rows = self.azimuth_order[lo + np.searchsorted(timestamps, start, side='left'):
+                                  lo + np.searchsorted(timestamps, end, side='right')]
+        return self.df.iloc[np.sort(rows)]
+
+
+class SweepBuffer:
+    """Latest return of every (azimuth bin, laser_id) cell of the lidar sweep.
+
+    Points are written into a preallocated array indexed by cell, so an update
+    costs O(new points). Every cell remembers when it was last written and a
+    snapshot returns the cells in that order, which is the row order the
+    concat + duplicated(keep="last") cycle used to produce.
+    """
+    def __init__(self, azimuth_bin=100, num_lasers=16, rotation_max_units=36000,
+                 columns=('X', 'Y', 'Z', 'D', 'azimuth', 'laser_id', 'first_timestamp', 'pcap_num')):
+        self.num_lasers = num_lasers
+        self.columns = list(columns)
+        num_cells = (int(round(rotation_max_units / azimuth_bin)) + 1) * num_lasers
+
+        self.data = np.zeros((num_cells, len(self.columns)), dtype=np.float64)
+        self.order = np.zeros(num_cells, dtype=np.int64)
+        self.counter = 0
+
+    def update(self, df):
+        if df.empty:
+            return
+        cells = df['azimuth'].values.astype(np.int64) * self.num_lasers + df['laser_id'].values.astype(np.int64)
+
+        # only the last return of a cell inside the batch is kept
+        _, first = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - first
+
+        self.data[cells[last]] = df[self.columns].values[last]
+        self.order[cells[last]] = self.counter + last + 1
+        self.counter += len(cells)
+
+    def snapshot(self):
+        filled = np.flatnonzero(self.order)
+        rows = filled[np.argsort(self.order[filled])]
+        return pd.DataFrame(self.data[rows], columns=self.columns)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.order))
 
 
 class PointProcessing:
-    def __init__(self, data_path):
+    """Timestamp lookups over decoded pcap files.
+
+    Every decoded pcap is kept as its own PointIndex in an LRU cache bounded by
+    memory_budget bytes (the most recent file is always kept). With spill_path
+    set, every pcap is decoded once into a memory-mapped PointStore there,
+    keyed by the pcap path, size and mtime, so a re-run on the same dataset
+    skips decoding and lookups read straight from the store.
+    """
+    def __init__(self, data_path, memory_budget=2 * 1024 ** 3, spill_path=None):
         self.data_path = data_path
         self.local_point_reader = PointReader(data_path=self.data_path)
+        self.memory_budget = memory_budget
+        self.spill_path = Path(spill_path) if spill_path is not None else None
+        if self.spill_path is not None:
+            self.spill_path.mkdir(parents=True, exist_ok=True)
+
+        self.cache = OrderedDict()
         self.processed_pcap = None
-        self.full_dataframe = pd.DataFrame()
+        self.index = None
 
-    def get_all_points_by_timestamp(self, timestamp, pcap_index, azimuth_bin=100, azimuth=None):
-        if pcap_index != self.processed_pcap:
-            self.processed_pcap = pcap_index
-            index_dataframe = self.local_point_reader.read_pcap(pcap_index, azimuth_bin)
-            self.full_dataframe = pd.concat([self.full_dataframe, index_dataframe], ignore_index=True)
-
-        if azimuth is not None:
-            return self.full_dataframe[(self.full_dataframe['azimuth'] == azimuth) &
-                                        [self.full_dataframe['first_timestamp'] == timestamp]]
+    def load_pcap(self, pcap_index, azimuth_bin=100):
+        key = (int(pcap_index), azimuth_bin)
+        if key in self.cache:
+            self.cache.move_to_end(key)
         else:
-            return self.full_dataframe[self.full_dataframe['first_timestamp'] == timestamp]
+            self.cache[key] = self.read_index(pcap_index, azimuth_bin)
+            self.evict()
+
+        self.processed_pcap = pcap_index
+        self.index = self.cache[key]
+        return self.index
+
+    def read_index(self, pcap_index, azimuth_bin):
+        store_path = self.spill_file(pcap_index)
+        if store_path is None:
+            return PointIndex(self.local_point_reader.read_pcap(pcap_index, azimuth_bin))
+
+        if not PointStore.exists(store_path):
+            self.local_point_reader.write_point_store(pcap_index, store_path)
+        print(f'Loading decoded points from {store_path}...')
+        return PointStore(store_path, azimuth_bin=azimuth_bin)
+
+    def spill_file(self, pcap_index):
+        if self.spill_path is None:
+            return None
+        pcap_file = self.local_point_reader.pcap_files[int(pcap_index) - 1]
+        stat = pcap_file.stat()
+        key = f'{pcap_file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'
+        return self.spill_path / f'{pcap_file.stem}.{hashlib.md5(key.encode()).hexdigest()}'
+
+    def evict(self):
+        while len(self.cache) > 1 and sum(x.nbytes for x in self.cache.values()) > self.memory_budget:
+            self.cache.popitem(last=False)
+
+    def get_all_points_by_timestamp(self, timestamp, pcap_index, azimuth_bin=100, azimuth=None):
+        self.load_pcap(pcap_index, azimuth_bin)
+        return self.index.get_by_timestamp(timestamp, azimuth=azimuth)
+
+    def get_all_points_by_timestamp_range(self, start, end, pcap_index, azimuth_bin=100, azimuth=None):
+        self.load_pcap(pcap_index, azimuth_bin)
+        return self.index.get_by_range(start, end, azimuth=azimuth)
+
+    def iter_points_by_timestamp(self, pcap_index, azimuth_bin=100):
+        """Stream (timestamp, points) pairs of a pcap file without decoding all of it first."""
+        for chunk in self.local_point_reader.iter_pcap_chunks(pcap_index, azimuth_bin):
+            for timestamp, points in chunk.groupby('first_timestamp', sort=False):
+                yield timestamp, points
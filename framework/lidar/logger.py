@@ -1,17 +1,30 @@
+import os
+import queue
+import threading
 from pathlib import Path
 from distutils.dir_util import copy_tree
 import shutil
 from datetime import datetime
+import numpy as np
+
+from .point_store import PointStore, PointStoreWriter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
 
 
 class LogWriter:
-    def __init__(self, data_path):
+    def __init__(self, data_path, point_store=False, results_path=None, link_mode='copy', lidar_format='txt'):
 
         self.data_path = data_path
-        self.results_path = Path(data_path) / 'results'
+        self.results_path = Path(data_path) / 'results' if results_path is None else Path(results_path)
         if self.results_path.is_dir():
             shutil.rmtree(str(self.results_path), ignore_errors=True)
-        self.results_path.mkdir()
+        self.results_path.mkdir(parents=True)
 
         self.calib_path = self.results_path / 'calib'
         self.image_path = self.results_path / 'leftImage'
@@ -27,28 +40,98 @@ class LogWriter:
 
         open(str(self.image_path / 'timestamps.txt'), "w+")
         open(str(self.lidar_path / 'timestamps.txt'), "w+")
+        # image name (without .bmp) of every lidar frame, the frames are paired with the images by it
+        open(str(self.lidar_path / 'images.txt'), "w+")
         copy_tree(str(Path(self.data_path) / 'data' / 'frames' / 'calib'), str(self.calib_path))
 
-        self.image_files = [x for x in (Path(self.data_path) / 'data' / 'frames').glob('*.bmp') if x.is_file()]
+        # frame name (without .bmp) -> path, shared with YML_Read
+        self.image_index = {x.stem: x for x in (Path(self.data_path) / 'data' / 'frames').glob('*.bmp')
+                            if x.is_file()}
+        assert link_mode in ('copy', 'hardlink', 'reflink'), f'Unknown link mode {link_mode}'
+        self.link_mode = link_mode
         self.indx = 0
 
+        # 'txt' is the csv dump of the whole frame, 'bin' (KITTI) and 'npy' hold float32 x, y, z, reflectance
+        assert lidar_format in ('txt', 'bin', 'npy'), f'Unknown lidar format {lidar_format}'
+        self.lidar_format = lidar_format
+        self.background = BackgroundWriter()
+
+        # every saved lidar frame is also appended to a columnar store, one segment per frame,
+        # the store is finalized on close and no frame can be saved after that
+        self.point_store = None
+        if point_store:
+            self.point_store = PointStoreWriter(self.lidar_path / 'store', azimuth_bin=100)
+        self.closed = False
+
+    def check_open(self):
+        if self.closed:
+            raise RuntimeError(f'LogWriter of {self.results_path} is closed')
+
     def save_images(self, yaml_img_name, image_time):
+        self.check_open()
 
-        for item in self.image_files:
-            if (str(item).split('\\')[-1])[:-4] == yaml_img_name:
-                shutil.copy(item, str(self.image_data_path))
+        item = self.image_index.get(yaml_img_name)
+        if item is not None:
+            link_or_copy(item, self.image_data_path / item.name, self.link_mode)
 
         with open(str(self.image_path / 'timestamps.txt'), "a+") as f:
             f.write("%s\n" % datetime.fromtimestamp(image_time).strftime('%Y-%m-%d %H:%M:%S.%f'))
 
-    def save_lidar_data(self, time_lidar, df):
+    def save_lidar_data(self, time_lidar, df, image_name=''):
+        self.check_open()
         print('Saving lidar data...')
         self.indx += 1
         with open(str(self.lidar_path / 'timestamps.txt'), "a+") as f:
             f.write("%s\n" % time_lidar)
+        with open(str(self.lidar_path / 'images.txt'), "a+") as f:
+            f.write("%s\n" % image_name)
+
+        path = self.lidar_data_path / (str(self.indx) + '.' + self.lidar_format)
+        if self.lidar_format == 'txt':
+            self.background.submit(self.save_dataframe, df, str(path))
+        else:
+            self.background.submit(save_points, df[['X', 'Y', 'Z', 'D']].values.astype(np.float32), path)
+        if self.point_store is not None:
+            self.point_store.append(df, keys=[self.indx], sizes=[len(df)])
+
+    def merge(self, part_path):
+        """Append the results written by another LogWriter (e.g. a YML_Read.power worker).
+
+        Images are moved as they are, lidar files are renumbered after the
+        frames already saved here and the timestamps and image names are
+        appended in order.
+        """
+        self.check_open()
+        part_path = Path(part_path)
+        for name in ['leftImage/timestamps.txt', 'velodyne_points/timestamps.txt', 'velodyne_points/images.txt']:
+            with open(str(part_path / name), 'rb') as src, open(str(self.results_path / name), 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+
+        for item in sorted((part_path / 'leftImage' / 'data').iterdir()):
+            shutil.move(str(item), str(self.image_data_path / item.name))
+
+        part_indx = 0
+        for item in (part_path / 'velodyne_points' / 'data').iterdir():
+            part_indx = max(part_indx, int(item.stem))
+            shutil.move(str(item), str(self.lidar_data_path / (str(self.indx + int(item.stem)) + item.suffix)))
+
+        part_store = part_path / 'velodyne_points' / 'store'
+        if self.point_store is not None and PointStore.exists(part_store):
+            part_store = PointStore(part_store)
+            for i in range(part_store.num_segments):
+                self.point_store.append(part_store.segment(i), keys=[self.indx + i + 1],
+                                        sizes=[part_store.segment_offsets[i + 1] - part_store.segment_offsets[i]])
+        self.indx += part_indx
 
-        path = str(self.lidar_data_path / (str(self.indx) + '.txt'))
-        self.save_dataframe(df, path=path)
+    def flush(self):
+        self.background.flush()
+
+    def close(self):
+        self.closed = True
+        self.background.close()
+        if self.point_store is not None:
+            self.point_store.close()
+            self.point_store = None
 
     def save_dataframe(self, df, path=None, name="main_dataFrame"):
         print('Saving dataframe...')
@@ -60,3 +143,82 @@ class LogWriter:
                 shutil.rmtree(str(results_path))
             results_path.mkdir()
             df.to_csv(str(results_path / str(name) + '.csv'))
+
+
+def link_or_copy(src, dst, mode='copy'):
+    """Place src at dst as a hardlink or a reflink (copy-on-write clone), falling back to a copy.
+
+    Both links cost no data I/O, a hardlink shares the file itself while a
+    reflink only shares the blocks and needs a filesystem like btrfs or XFS.
+    """
+    if mode == 'hardlink':
+        try:
+            os.link(str(src), str(dst))
+            return
+        except OSError:
+            pass
+    elif mode == 'reflink' and fcntl is not None:
+        with open(str(src), 'rb') as s, open(str(dst), 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copy(str(src), str(dst))
+
+
+def save_points(points, path):
+    if Path(path).suffix == '.npy':
+        np.save(str(path), points)
+    else:
+        points.tofile(str(path))
+
+
+class BackgroundWriter:
+    """Run file writes on one thread in submission order.
+
+    The queue is bounded, so a slow disk throttles the producer instead of
+    buffering frames without limit. A failed write is raised on the next
+    submit, flush or close. Nothing can be submitted after close.
+    """
+    def __init__(self, queue_size=16):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        if self.closed:
+            raise RuntimeError('BackgroundWriter is closed')
+        if self.error is not None:
+            raise self.error
+        self.queue.put((func, args))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            func, args = item
+            if self.error is None:
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def flush(self):
+        """Wait until every submitted write is done."""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
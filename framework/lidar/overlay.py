@@ -0,0 +1,87 @@
+from pathlib import Path
+import numpy as np
+import cv2
+
+from .logger import BackgroundWriter
+from .smi import to_grayscale
+
+
+def depth_colors(depth, max_depth=None, colormap=cv2.COLORMAP_JET):
+    """BGR colour of every depth from a 256 entry OpenCV colormap LUT, near points red, far points blue."""
+    depth = np.asarray(depth, dtype=np.float64)
+    if max_depth is None:
+        max_depth = depth.max() if len(depth) else 1.0
+    levels = 255 - np.clip(depth / max(max_depth, 1e-6) * 255, 0, 255).astype(np.uint8)
+    lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), colormap).reshape(256, 3)
+    return lut[levels]
+
+
+def render_overlay(image, pixels, depth, valid, image_size=(1920, 1080), radius=1, max_depth=None):
+    """Draw projected lidar points coloured by depth onto a BGR copy of the image.
+
+    pixels, depth and valid are the output of project_points. The centred
+    pixel coordinates are shifted to array indices like in SMIEvaluator.sample,
+    so the overlay shows the intensities the SMI is computed from. Points are
+    painted far to near, so the nearest point wins where they overlap, and
+    every point covers a disc of the given radius.
+    """
+    gray = to_grayscale(image)
+    canvas = cv2.cvtColor(np.ascontiguousarray(gray, dtype=np.uint8), cv2.COLOR_GRAY2BGR)
+    height, width = canvas.shape[:2]
+
+    x = np.trunc(pixels[valid, 0] + image_size[0] / 2 - 1).astype(np.int64)
+    y = np.trunc(pixels[valid, 1] + image_size[1] / 2 - 1).astype(np.int64)
+    z = depth[valid]
+    order = np.argsort(-z, kind='stable')
+    x, y, colors = x[order], y[order], depth_colors(z[order], max_depth)
+
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dx * dx + dy * dy > radius * radius:
+                continue
+            xs, ys = x + dx, y + dy
+            inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+            canvas[ys[inside], xs[inside]] = colors[inside]
+    return canvas
+
+
+class OverlayWriter:
+    """Write rendered overlays as images and optionally as one video.
+
+    Image files are encoded on a background thread, frames are streamed into
+    cv2.VideoWriter as they come, so a whole sequence can be checked at once.
+    """
+    def __init__(self, output_path, video_path=None, fps=10, fourcc='mp4v', save_images=True):
+        self.output_path = Path(output_path)
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.video_path = video_path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.save_images = save_images
+        self.video = None
+        self.background = BackgroundWriter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, name, frame):
+        if self.save_images:
+            self.background.submit(cv2.imwrite, str(self.output_path / name), frame)
+        if self.video_path is not None:
+            if self.video is None:
+                self.video = cv2.VideoWriter(str(self.video_path), cv2.VideoWriter_fourcc(*self.fourcc), self.fps,
+                                             (frame.shape[1], frame.shape[0]))
+            self.video.write(frame)
+
+    def write_batch(self, names, frames):
+        for name, frame in zip(names, frames):
+            self.write(name, frame)
+
+    def close(self):
+        self.background.close()
+        if self.video is not None:
+            self.video.release()
+            self.video = None
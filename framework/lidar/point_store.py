@@ -0,0 +1,166 @@
+import os
+import json
+import uuid
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+POINT_STORE_COLUMNS = [('X', 'float32'), ('Y', 'float32'), ('Z', 'float32'), ('D', 'uint8'),
+                       ('azimuth', 'uint16'), ('laser_id', 'uint8'), ('first_timestamp', 'uint32')]
+
+
+class PointStoreWriter:
+    """Append segments of points (pcap packets or saved lidar frames) to a columnar point store.
+
+    Every column goes to its own raw binary file. Segments are identified by a
+    uint32 key (packet timestamp or frame number) and the sorted key index is
+    written on close. The store is built in a temporary folder of its own and
+    moved into place at the end, so a half-written store is never picked up
+    and several processes can build the same store at once: the first one to
+    finish wins, the others keep its store.
+    """
+    def __init__(self, path, azimuth_bin=1, constants=None):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp')
+        self.tmp_path.mkdir(parents=True)
+
+        self.azimuth_bin = azimuth_bin
+        self.constants = constants if constants is not None else {}
+        self.files = {name: open(str(self.tmp_path / f'{name}.bin'), 'wb') for name, _ in POINT_STORE_COLUMNS}
+        self.keys = []
+        self.sizes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, columns, keys, sizes):
+        for name, dtype in POINT_STORE_COLUMNS:
+            np.asarray(columns[name]).astype(dtype, copy=False).tofile(self.files[name])
+        self.keys.append(np.asarray(keys, dtype=np.uint32).ravel())
+        self.sizes.append(np.asarray(sizes, dtype=np.int64).ravel())
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+        keys = np.concatenate(self.keys) if self.keys else np.zeros(0, dtype=np.uint32)
+        sizes = np.concatenate(self.sizes) if self.sizes else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        order = np.argsort(keys, kind='stable')
+
+        np.save(str(self.tmp_path / 'segment_offsets.npy'), offsets)
+        np.save(str(self.tmp_path / 'index_keys.npy'), keys[order])
+        np.save(str(self.tmp_path / 'index_segments.npy'), order.astype(np.int64))
+        with open(str(self.tmp_path / 'meta.json'), 'w') as f:
+            json.dump({'length': int(offsets[-1]), 'columns': dict(POINT_STORE_COLUMNS),
+                       'azimuth_bin': self.azimuth_bin, 'constants': self.constants}, f)
+
+        if self.path.is_dir() and not PointStore.exists(self.path):
+            shutil.rmtree(str(self.path), ignore_errors=True)
+        try:
+            os.replace(str(self.tmp_path), str(self.path))
+        except OSError:
+            if not PointStore.exists(self.path):
+                raise
+            # another writer finished the same store first
+            shutil.rmtree(str(self.tmp_path), ignore_errors=True)
+        return PointStore(self.path)
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(str(self.tmp_path), ignore_errors=True)
+
+
+class PointStore:
+    """Read-only, memory-mapped view of a store written by PointStoreWriter.
+
+    Columns are np.memmap arrays and slices of them are views, so reading a
+    packet or a frame does not copy the rest of the capture into memory.
+    Lookups by key mirror PointIndex, so a store can be used in its place.
+    """
+    def __init__(self, path, azimuth_bin=None):
+        self.path = Path(path)
+        with open(str(self.path / 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        self.azimuth_bin = azimuth_bin
+        self.length = self.meta['length']
+        self.columns = {}
+        for name, dtype in self.meta['columns'].items():
+            if self.length:
+                self.columns[name] = np.memmap(str(self.path / f'{name}.bin'), dtype=dtype, mode='r',
+                                               shape=(self.length,))
+            else:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+
+        self.segment_offsets = np.load(str(self.path / 'segment_offsets.npy'))
+        self.index_keys = np.load(str(self.path / 'index_keys.npy'))
+        self.index_segments = np.load(str(self.path / 'index_segments.npy'))
+
+    @staticmethod
+    def exists(path):
+        return (Path(path) / 'meta.json').is_file()
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def num_segments(self):
+        return len(self.segment_offsets) - 1
+
+    @property
+    def nbytes(self):
+        # the columns live in the page cache, only the index is resident
+        return self.segment_offsets.nbytes + self.index_keys.nbytes + self.index_segments.nbytes
+
+    def slice(self, lo, hi):
+        return {name: column[lo:hi] for name, column in self.columns.items()}
+
+    def segment(self, indx):
+        return self.slice(self.segment_offsets[indx], self.segment_offsets[indx + 1])
+
+    def points(self, indx, columns=('X', 'Y', 'Z', 'D')):
+        """Return the segment as an (N, len(columns)) float32 array."""
+        segment = self.segment(indx)
+        return np.column_stack([segment[name].astype(np.float32, copy=False) for name in columns])
+
+    def find_segments(self, start, end):
+        lo = np.searchsorted(self.index_keys, start, side='left')
+        hi = np.searchsorted(self.index_keys, end, side='right')
+        return np.sort(self.index_segments[lo:hi])
+
+    def get_by_timestamp(self, timestamp, azimuth=None):
+        return self.get_by_range(timestamp, timestamp, azimuth=azimuth)
+
+    def get_by_range(self, start, end, azimuth=None):
+        segments = self.find_segments(start, end)
+        if len(segments) and segments[-1] - segments[0] == len(segments) - 1:
+            columns = self.slice(self.segment_offsets[segments[0]], self.segment_offsets[segments[-1] + 1])
+        else:
+            parts = [self.segment(x) for x in segments]
+            columns = {name: np.concatenate([x[name] for x in parts]) if parts else column[:0]
+                       for name, column in self.columns.items()}
+
+        df = self.to_dataframe(columns)
+        if azimuth is not None:
+            df = df[df['azimuth'].values == azimuth]
+        return df
+
+    def to_dataframe(self, columns):
+        df = pd.DataFrame(columns)
+        if self.azimuth_bin is not None and self.azimuth_bin != self.meta['azimuth_bin']:
+            azimuth = df['azimuth'].values * self.meta['azimuth_bin'] / self.azimuth_bin
+            df['azimuth'] = np.round(azimuth).astype(np.int64)
+        for name, value in self.meta['constants'].items():
+            df[name] = value
+        return df
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def rotation_matrix(cam_pos):
+    """Rotation roll * pitch * yaw of a pose cam_pos = [roll, pitch, yaw, tx, ty, tz]."""
+    cr, sr = np.cos(cam_pos[0]), np.sin(cam_pos[0])
+    cp, sp = np.cos(cam_pos[1]), np.sin(cam_pos[1])
+    cy, sy = np.cos(cam_pos[2]), np.sin(cam_pos[2])
+    roll = np.array([[1, 0, 0], [0, cr, -sr], [0, sr, cr]])
+    pitch = np.array([[cp, 0, sp], [0, 1, 0], [-sp, 0, cp]])
+    yaw = np.array([[cy, -sy, 0], [sy, cy, 0], [0, 0, 1]])
+    return roll @ pitch @ yaw
+
+
+def distort(x, y, D):
+    """Radial model of SMI_calculations.Projection: (1 + D0 r + D1 r^2 + D4 r^3) * atan(r) / r, r = x^2 + y^2."""
+    r = x * x + y * y
+    safe_r = np.where(r > 0, r, 1.0)
+    scale = (1 + D[0] * r + D[1] * r ** 2 + D[4] * r ** 3) * np.where(r > 0, np.arctan(safe_r) / safe_r, 1.0)
+    return x * scale, y * scale
+
+
+def project_points(points, cam_pos, K, D=None, image_size=(1920, 1080)):
+    """Project lidar points into the image for one 6-DoF pose in a single vectorized pass.
+
+    points is an (N, 3) array (extra columns are ignored), cam_pos is
+    [roll, pitch, yaw, tx, ty, tz]. Pixel coordinates are centred like in
+    SMI_calculations.Projection, so a point is valid when it is in front of
+    the camera and |u| < width / 2, |v| < height / 2. Passing D applies the
+    radial distortion model.
+
+    Returns pixels (N, 2), depth (N,) along the optical axis and a validity mask (N,).
+    """
+    points = np.asarray(points, dtype=np.float64)[:, :3]
+    cam_coord = points @ rotation_matrix(cam_pos).T + np.asarray(cam_pos[3:6], dtype=np.float64)
+    depth = cam_coord[:, 2]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = cam_coord[:, 0] / depth
+        y = cam_coord[:, 1] / depth
+    if D is not None:
+        x, y = distort(x, y, D)
+
+    K = np.asarray(K, dtype=np.float64)
+    pixels = np.empty((len(points), 2))
+    pixels[:, 0] = K[0, 0] * x + K[0, 1] * y + K[0, 2]
+    pixels[:, 1] = K[1, 0] * x + K[1, 1] * y + K[1, 2]
+
+    valid = (depth > 0) & (np.abs(pixels[:, 0]) < image_size[0] / 2) & (np.abs(pixels[:, 1]) < image_size[1] / 2)
+    return pixels, depth, valid
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import numpy as np
+
+from .projection import project_points
+
+
+def to_grayscale(image):
+    """Grayscale uint8 array of a PIL image (same conversion as Image.convert('L')) or of an array."""
+    if hasattr(image, 'convert'):
+        return np.asarray(image.convert('L'))
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = image[:, :, 0] * 0.299 + image[:, :, 1] * 0.587 + image[:, :, 2] * 0.114
+    return image
+
+
+def kde_grid(values, num_bins=255):
+    """gaussian_kde(values).evaluate(range(num_bins)) from a histogram of the values.
+
+    The samples are binned to integers and the histogram is smoothed with the
+    Gaussian kernel of Scott's rule, which is exact for integer valued samples
+    such as reflectivity and 8-bit intensity.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    sigma = values.std(ddof=1) * n ** (-1 / 5)
+
+    support = np.arange(int(np.ceil(values.max())) + 1)
+    counts = np.bincount(np.clip(np.round(values), 0, None).astype(np.int64), minlength=len(support))
+    offsets = (np.arange(num_bins)[:, None] - support[None, :]) / sigma
+    return np.exp(-0.5 * offsets ** 2) @ counts / (n * sigma * np.sqrt(2 * np.pi))
+
+
+def joint_histogram(reflectivity, intensity, num_bins=255, value_range=255):
+    """np.histogram2d(..., bins=num_bins, range=[[0, value_range]] * 2, density=True)[0] with bincount."""
+    scale = num_bins / value_range
+    inside = (reflectivity >= 0) & (reflectivity <= value_range) & (intensity >= 0) & (intensity <= value_range)
+    r = np.minimum((reflectivity[inside] * scale).astype(np.int64), num_bins - 1)
+    i = np.minimum((intensity[inside] * scale).astype(np.int64), num_bins - 1)
+    joint = np.bincount(r * num_bins + i, minlength=num_bins * num_bins).reshape(num_bins, num_bins)
+    return joint / (inside.sum() / scale ** 2)
+
+
+def squared_loss_mutual_information(reflectivity, intensity, num_bins=255):
+    """SMI = sum 0.5 * p(r) p(i) (p(r, i) / (p(r) p(i)) - 1)^2 evaluated with array ops.
+
+    Returns 0 when the densities cannot be estimated (fewer than two samples
+    or a constant signal), e.g. for a pose that projects no points into the image.
+    """
+    reflectivity = np.asarray(reflectivity, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    if len(reflectivity) < 2 or reflectivity.std() == 0 or intensity.std() == 0:
+        return 0.0
+
+    marginals = np.outer(kde_grid(reflectivity, num_bins), kde_grid(intensity, num_bins))
+    joint = joint_histogram(reflectivity, intensity, num_bins)
+
+    mask = marginals > 0
+    return float(0.5 * np.sum(marginals[mask] * (joint[mask] / marginals[mask] - 1) ** 2))
+
+
+class SMIEvaluator:
+    """SMI between lidar reflectivity and image intensity for a camera pose.
+
+    Grayscale versions of colour images are kept by image id in an LRU cache of
+    cache_size images, every evaluation is one batched projection plus a
+    fancy-indexed lookup. Grayscale arrays are used as they are.
+    """
+    def __init__(self, K, D=None, image_size=(1920, 1080), num_bins=255, cache_size=4):
+        self.K = K
+        self.D = D
+        self.image_size = image_size
+        self.num_bins = num_bins
+        self.cache_size = cache_size
+        self.gray_cache = OrderedDict()
+
+    def grayscale(self, image):
+        if isinstance(image, np.ndarray) and image.ndim == 2:
+            # already grayscale, e.g. from CalibrationFrames, nothing to cache
+            return image
+        key = id(image)
+        if key in self.gray_cache:
+            self.gray_cache.move_to_end(key)
+            return self.gray_cache[key][1]
+
+        gray = to_grayscale(image)
+        if self.cache_size > 0:
+            # the image is kept with its entry, so its id cannot be reused while cached
+            self.gray_cache[key] = (image, gray)
+            while len(self.gray_cache) > self.cache_size:
+                self.gray_cache.popitem(last=False)
+        return gray
+
+    def sample(self, cam_pos, points, image):
+        """Reflectivity of the projected points and the image intensity under them."""
+        points = np.asarray(points)
+        pixels, _, valid = project_points(points, cam_pos, self.K, self.D, self.image_size)
+        gray = self.grayscale(image)
+
+        # pixel coordinates are centred, shift them like SMI_calculations.get_intensivity
+        x = np.trunc(pixels[valid, 0] + self.image_size[0] / 2 - 1).astype(np.int64)
+        y = np.trunc(pixels[valid, 1] + self.image_size[1] / 2 - 1).astype(np.int64)
+        return points[valid, 3].astype(np.float64), gray[y, x].astype(np.float64)
+
+    def __call__(self, cam_pos, points, image):
+        reflectivity, intensity = self.sample(cam_pos, points, image)
+        return squared_loss_mutual_information(reflectivity, intensity, self.num_bins)
@@ -2,27 +2,41 @@ import torch
 import torchvision
 from torch import nn as nn
 from torch.nn import Module
+from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class MainModel(Module):
-    def __init__(self, size, same_size_output=False):
+    def __init__(self, size=None, same_size_output=False, pretrained=True):
         super(MainModel, self).__init__()
 
-        self.backbone = ResNetBackbone()
+        self.backbone = ResNetBackbone(pretrained=pretrained)
         self.head = FPNHead(size, same_size_output=same_size_output)
         self.depthhead = ConvBlock(256, 1, 1, 3)
 
     def forward(self, image):
         x = self.backbone.get_features(image)
-        out = self.head(x)
+        out = self.head(x, image.shape[-2:])
         out = self.depthhead(out)
         return out
 
+    def fuse(self):
+        """Fold the BatchNorm of every ConvBlock into its convolution, for inference and export only."""
+        for module in self.modules():
+            if isinstance(module, ConvBlock):
+                module.fuse()
+        return self
+
 
 class ResNetBackbone(Module):
-    def __init__(self):
+    def __init__(self, pretrained=True, quantizable=False):
         super(ResNetBackbone, self).__init__()
-        self.net = torchvision.models.resnet18(pretrained=True)
+        # pretrained=False skips the ImageNet weights when a checkpoint overwrites them anyway
+        if quantizable:
+            # same parameters, residual adds through FloatFunctional so the blocks can run in int8
+            self.net = torchvision.models.quantization.resnet18(pretrained=pretrained, quantize=False)
+        else:
+            self.net = torchvision.models.resnet18(pretrained=pretrained)
 
     def get_features(self, x):
         x = self.net.conv1(x)
@@ -42,42 +56,41 @@ class ResNetBackbone(Module):
 
 
 class FPNHead(Module):
-    def __init__(self, size, same_size_output=False):
+    """Top-down FPN path, every level is upsampled to the size of the lateral feature it is added to.
+
+    The sizes are taken from the feature maps at runtime, so one head serves
+    any input resolution. size is accepted for old callers and ignored, with
+    same_size_output the result is upsampled to the image size given to forward.
+    """
+    def __init__(self, size=None, same_size_output=False):
         super(FPNHead, self).__init__()
         self.same_size_output = same_size_output
-        self.size = size
         self.block4 = ConvBlock(in_channels=512, out_channels=256, kernel_size=1, num_layer=1)
         self.block3 = ConvBlock(in_channels=256, out_channels=256, kernel_size=1, num_layer=1)
         self.block2 = ConvBlock(in_channels=128, out_channels=256, kernel_size=1, num_layer=1)
         self.block1 = ConvBlock(in_channels=64, out_channels=256, kernel_size=1, num_layer=1)
+        # plain additions in float, observed and run in int8 once the model is quantized
+        self.add3 = nn.quantized.FloatFunctional()
+        self.add2 = nn.quantized.FloatFunctional()
+        self.add1 = nn.quantized.FloatFunctional()
 
-        self.define_upsampling()
-
-    def forward(self, features):
+    def forward(self, features, image_size=None):
         c4 = self.block4(features[3])
-        c3 = self.upsample4(c4) + self.block3(features[2])
-        c2 = self.upsample3(c3) + self.block2(features[1])
-        c1 = self.upsample2(c2) + self.block1(features[0])
+        c3 = self.block3(features[2])
+        c3 = self.add3.add(upsample(c4, c3.shape[-2:]), c3)
+        c2 = self.block2(features[1])
+        c2 = self.add2.add(upsample(c3, c2.shape[-2:]), c2)
+        c1 = self.block1(features[0])
+        c1 = self.add1.add(upsample(c2, c1.shape[-2:]), c1)
 
         if self.same_size_output:
-            c1 = self.upsample1(c1)
+            c1 = upsample(c1, image_size)
 
         return c1
 
-    def define_upsampling(self):
-        if self.same_size_output:
-            self.upsample4 = nn.Upsample(size=self.size[3], mode='bilinear', align_corners=True)
-            self.upsample3 = nn.Upsample(size=self.size[2], mode='bilinear', align_corners=True)
-            self.upsample2 = nn.Upsample(size=self.size[1], mode='bilinear', align_corners=True)
-            self.upsample1 = nn.Upsample(size=self.size[0], mode='bilinear', align_corners=True)
-        else:
-            self.upsample4 = nn.Upsample(size=self.size[2], mode='bilinear', align_corners=True)
-            self.upsample3 = nn.Upsample(size=self.size[1], mode='bilinear', align_corners=True)
-            self.upsample2 = nn.Upsample(size=self.size[0], mode='bilinear', align_corners=True)
 
-    def change_size(self, sizes):
-        self.size = sizes
-        self.define_upsampling()
+def upsample(x, size):
+    return F.interpolate(x, size=tuple(size), mode='bilinear', align_corners=True)
 
 
 class ConvBlock(Module):
@@ -102,3 +115,19 @@ class ConvBlock(Module):
     def forward(self, x):
         out = self.block(x)
         return out
+
+    def fuse(self):
+        """Replace conv_i, bn_i by one convolution with the eval-mode BatchNorm folded in."""
+        for name, module in list(self.block.named_children()):
+            if isinstance(module, nn.BatchNorm2d):
+                conv_name = 'conv_' + name.split('_')[1]
+                setattr(self.block, conv_name, fuse_conv_bn_eval(getattr(self.block, conv_name), module))
+                setattr(self.block, name, nn.Identity())
+        return self
+
+    def fuse_model(self):
+        """Fuse conv_1 + bn_1 + relu_1 and every later conv_i + bn_i in place for eager-mode quantization."""
+        convs = [name for name in self.block._modules if name.startswith('conv_')]
+        groups = [['conv_1', 'bn_1', 'relu_1']] + [[name, 'bn_' + name.split('_')[1]] for name in convs[1:]]
+        torch.ao.quantization.fuse_modules(self.block, groups, inplace=True)
+        return self
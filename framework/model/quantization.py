@@ -0,0 +1,53 @@
+import torch
+from torch.ao import quantization
+
+from .base import MainModel, ResNetBackbone
+
+
+class QuantizableMainModel(MainModel):
+    """MainModel with the ResNet18 backbone and the FPN head in int8.
+
+    The image is quantized on entry, the FPN output is dequantized before
+    the depth head, which stays in float because it regresses the depth
+    itself. The parameters and state dict keys are those of MainModel, so
+    fp32 checkpoints load as they are. quantize() turns a calibrated copy
+    into the int8 model.
+    """
+    def __init__(self, size=None, same_size_output=False):
+        super(QuantizableMainModel, self).__init__(size, same_size_output=same_size_output, pretrained=False)
+        self.backbone = ResNetBackbone(pretrained=False, quantizable=True)
+        self.quant = quantization.QuantStub()
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, image):
+        x = self.backbone.get_features(self.quant(image))
+        out = self.head(x, image.shape[-2:])
+        out = self.depthhead(self.dequant(out))
+        return out
+
+    def fuse_model(self):
+        self.backbone.net.fuse_model()
+        for block in (self.head.block1, self.head.block2, self.head.block3, self.head.block4):
+            block.fuse_model()
+        return self
+
+
+def quantize(state_dict, calibration_images, backend='fbgemm', same_size_output=True):
+    """Static post-training int8 quantization of a MainModel checkpoint.
+
+    calibration_images is an iterable of (N, 3, H, W) batches the activation
+    ranges are observed on. Returns the converted model in eval mode.
+    """
+    torch.backends.quantized.engine = backend
+    model = QuantizableMainModel(same_size_output=same_size_output)
+    model.load_state_dict(state_dict)
+    model.eval().fuse_model()
+
+    model.qconfig = quantization.get_default_qconfig(backend)
+    model.depthhead.qconfig = None
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for image in calibration_images:
+            model(image)
+    quantization.convert(model, inplace=True)
+    return model
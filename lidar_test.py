@@ -1,8 +1,8 @@
 from framework.lidar import *
 
 if __name__ == '__main__':
-    main_yml_reader = YML_Read(Path().absolute())
-    main_yml_reader.power()
+    with YML_Read(Path().absolute()) as main_yml_reader:
+        main_yml_reader.power()
 
     print(Path().absolute())
     print('kek')
@@ -8,9 +8,6 @@ if __name__ == "__main__":
     with open('/home/fedor/projects/test_list.txt', 'r') as f:
         file_list = f.read().split('\n')
 
-    for indx, sample in enumerate(file_list):
-        path = '/home/fedor/projects/ScannTech/frames/' + sample
-        if indx == 0:
-            test.update_model(path)
-        print(path)
-        test.test_sample(path, '/home/fedor/projects/ScannTech/vidoe/' + f'{indx}.jpg')
+    paths = ['/home/fedor/projects/ScannTech/frames/' + sample for sample in file_list if sample]
+    # frames of any resolution, batched by shape
+    test.test_files(paths, ['/home/fedor/projects/ScannTech/vidoe/' + f'{indx}.jpg' for indx in range(len(paths))])
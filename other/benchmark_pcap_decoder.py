@@ -0,0 +1,120 @@
+# run from the repository root: python -m other.benchmark_pcap_decoder [packets] [legacy_packets]
+import struct
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from framework.lidar.lidar import PointReader, PCAP_GLOBAL_HEADER_SIZE, PCAP_RECORD_HEADER_SIZE, \
+    UDP_HEADER_SIZE, VLP16_PACKET_SIZE
+
+parser = argparse.ArgumentParser()
+parser.add_argument('packets', nargs='?', type=int, default=200,
+                    help='number of VLP-16 packets in the synthetic capture')
+parser.add_argument('legacy_packets', nargs='?', type=int, default=20,
+                    help='number of packets decoded with the per-return parser')
+
+args = parser.parse_args()
+
+
+def synthetic_capture(num_packets, seed=0):
+    rng = np.random.RandomState(seed)
+    data = bytearray(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+    azimuth = 0
+    for indx in range(num_packets):
+        record = bytearray(struct.pack('<IIII', indx, 0, UDP_HEADER_SIZE + VLP16_PACKET_SIZE,
+                                       UDP_HEADER_SIZE + VLP16_PACKET_SIZE))
+        record += bytearray(UDP_HEADER_SIZE)
+        for block in range(12):
+            record += struct.pack('<HH', 0xeeff, azimuth)
+            for channel in range(32):
+                record += struct.pack('<HB', rng.randint(0, 50000), rng.randint(0, 256))
+            azimuth = (azimuth + 40) % 36000
+        record += struct.pack('<IH', 1000 + indx * 1327, 0x2237)
+        assert len(record) == PCAP_RECORD_HEADER_SIZE + UDP_HEADER_SIZE + VLP16_PACKET_SIZE
+        data += record
+    return bytes(data)
+
+
+def legacy_point(reader, dis, azimuth, laser_id):
+    r = dis * reader.DISTANCE_RESOLUTION
+    omega = reader.LASER_ANGLES[laser_id] * np.pi / 180.0
+    alpha = (azimuth / 100.0) * (np.pi / 180.0)
+    return r * np.cos(omega) * np.sin(alpha), r * np.cos(omega) * np.cos(alpha), r * np.sin(omega)
+
+
+def legacy_sequence(reader, data, seq_offset, seq_index, first_timestamp, pcap_num, rows):
+    """Per-return loop of the removed PointReader.seq_processing, rows are collected in a list."""
+    flag, first_azimuth = struct.unpack_from("<HH", data, seq_offset)
+    step_azimuth = 0
+    assert hex(flag) == '0xeeff', 'Flag error'
+    for step in range(2):
+        if step == 0 and seq_index % 2 == 0 and seq_index < 22:
+            flag, third_azimuth = struct.unpack_from("<HH", data, seq_offset + 4 + 3 * 16 * 2)
+            assert hex(flag) == '0xeeff', 'Flag error'
+            if third_azimuth < first_azimuth:
+                step_azimuth = third_azimuth + reader.ROTATION_MAX_UNITS - first_azimuth
+            else:
+                step_azimuth = third_azimuth - first_azimuth
+
+        arr = struct.unpack_from('<' + "HB" * reader.NUM_LASERS, data, seq_offset + 4 + step * 3 * 16)
+
+        for i in range(reader.NUM_LASERS):
+            azimuth = first_azimuth + (step_azimuth * (55.296 / 1e6 * step + i * 2.304 / 1e6)) / (2 * 55.296 / 1e6)
+            if azimuth > reader.ROTATION_MAX_UNITS:
+                azimuth -= reader.ROTATION_MAX_UNITS
+
+            x, y, z = legacy_point(reader, arr[i * 2], azimuth, i)
+            rows.append([x, y, z, arr[i * 2 + 1], round(azimuth * 1.0 / reader.azimuth_bin), i, first_timestamp,
+                         pcap_num])
+        seq_index += 1
+
+
+def legacy_decode(reader, pcap_data, pcap_num):
+    pcap_data = pcap_data[PCAP_GLOBAL_HEADER_SIZE:]
+    record_size = PCAP_RECORD_HEADER_SIZE + UDP_HEADER_SIZE + VLP16_PACKET_SIZE
+    rows = []
+    for offset in range(0, len(pcap_data), record_size):
+        cur_data = pcap_data[offset + PCAP_RECORD_HEADER_SIZE + UDP_HEADER_SIZE: offset + record_size]
+        first_timestamp, _ = struct.unpack_from("<IH", cur_data, offset=1200)
+        for seq_offset in range(0, 1100, 100):
+            legacy_sequence(reader, cur_data, seq_offset, 0, first_timestamp, pcap_num, rows)
+    return pd.DataFrame(rows, columns=reader.df.columns)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        pcap_path = Path(tmp) / 'data' / 'pcap'
+        pcap_path.mkdir(parents=True)
+        (pcap_path / 'synthetic.pcap').write_bytes(synthetic_capture(args.packets))
+
+        reader = PointReader(tmp)
+        reader.azimuth_bin = 100
+        t = time.perf_counter()
+        new_df = reader.read_pcap(1, azimuth_bin=100)
+        new_time = time.perf_counter() - t
+        print(f'Vectorized: {args.packets} packets, {len(new_df)} points, {new_time:.4f} s')
+
+        legacy_reader = PointReader(tmp)
+        legacy_reader.azimuth_bin = 100
+        legacy_data = synthetic_capture(args.legacy_packets)
+        t = time.perf_counter()
+        old_df = legacy_decode(legacy_reader, legacy_data, 0)
+        old_time = time.perf_counter() - t
+        print(f'Per-return: {args.legacy_packets} packets, {len(old_df)} points, {old_time:.4f} s')
+
+        per_packet_new = new_time / args.packets
+        per_packet_old = old_time / args.legacy_packets
+        print(f'Speedup per packet: {per_packet_old / per_packet_new:.1f}x')
+
+        # the per-return parser skips the last firing block of every packet
+        expected = new_df.values.reshape(args.packets, 12, 32, -1)[:args.legacy_packets, :11]
+        expected = expected.reshape(-1, new_df.shape[1])
+        assert np.allclose(expected, old_df.values.astype(np.float64)), 'Decoders disagree'
+        print('Outputs match')
+
+
+if __name__ == '__main__':
+    main()
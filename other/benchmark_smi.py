@@ -0,0 +1,72 @@
+# run from the repository root: python -m other.benchmark_smi [points] [repeats]
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from scipy.stats import gaussian_kde
+
+from framework.lidar.SMI_calculation import SMI_calculations
+from framework.lidar.smi import SMIEvaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument('points', nargs='?', type=int, default=3000,
+                    help='number of lidar points in the synthetic frame')
+parser.add_argument('repeats', nargs='?', type=int, default=5,
+                    help='number of vectorized evaluations to average')
+
+args = parser.parse_args()
+
+
+def synthetic_frame(num_points, seed=0):
+    rng = np.random.RandomState(seed)
+    image = Image.fromarray(rng.randint(0, 256, (1080, 1920, 3)).astype(np.uint8))
+    points = np.column_stack([rng.uniform(-10, 10, num_points), rng.uniform(-5, 5, num_points),
+                              rng.uniform(3, 40, num_points), rng.randint(0, 256, num_points)])
+    return points, image
+
+
+def legacy_smi(cam_pos, points, image, K):
+    SMI = 0.0
+    list_ref = []
+    list_intens = []
+    for i in range(len(points)):
+        pixel = SMI_calculations.Projection(None, points[i][:3], cam_pos, K, None)
+        if pixel is not None:
+            list_ref.append(points[i][3])
+            list_intens.append(image.convert('L').getpixel((int(pixel[0] + 959), int(pixel[1] + 539))))
+    ref = gaussian_kde(list_ref).evaluate(range(0, 255))
+    inte = gaussian_kde(list_intens).evaluate(range(0, 255))
+    mutual = np.histogram2d(list_ref, list_intens, bins=255, range=[[0, 255], [0, 255]], density=True)
+    for i in range(0, 255):
+        for j in range(0, 255):
+            SMI += 0.5 * ref[i] * inte[j] * ((mutual[0][i][j] / (ref[i] * inte[j])) - 1) ** 2
+    return SMI
+
+
+def main():
+    points, image = synthetic_frame(args.points)
+    K = np.array([[500., 0, 0], [0, 500., 0], [0, 0, 1]])
+    cam_pos = [0.02, -0.01, 0.03, 0.1, -0.05, 0.2]
+
+    t = time.perf_counter()
+    old_smi = legacy_smi(cam_pos, points, image, K)
+    old_time = time.perf_counter() - t
+    print(f'Per-point loop: SMI {old_smi:.8f}, {old_time:.4f} s')
+
+    evaluator = SMIEvaluator(K)
+    t = time.perf_counter()
+    new_smi = evaluator(cam_pos, points, image)
+    print(f'Vectorized (first call, grayscale conversion): {time.perf_counter() - t:.4f} s')
+    t = time.perf_counter()
+    for _ in range(args.repeats):
+        new_smi = evaluator(cam_pos, points, image)
+    new_time = (time.perf_counter() - t) / args.repeats
+    print(f'Vectorized: SMI {new_smi:.8f}, {new_time:.4f} s')
+
+    print(f'Speedup: {old_time / new_time:.1f}x')
+    assert np.isclose(old_smi, new_smi, rtol=1e-6), 'SMI values disagree'
+    print('Values match')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,6 @@ tester = Tester(ex_img_path='/home/fedor/Downloads/Telegram Desktop/23572.jpg',
 
 
 img_path = '/home/fedor/Downloads/Telegram Desktop/20180108161434_9916.jpg'
-tester.update_model(img_path)
 
 t = time.clock()
 
@@ -1,25 +1,14 @@
 import torch
-from model.base import MainModel
-from data.dataset import MainDataset
-from engine.engine import Trainer
+from framework.model.base import MainModel
+from framework.data.dataset import MainDataset
+from framework.engine.trainer import Trainer
 
 if __name__ == '__main__':
     split = 'train'
-    sizes = []
     dataset = MainDataset('.\data', split)
 
-    model = MainModel(size=[0, 0, 0, 0])
-    sample = dataset.__getitem__(0)
-    img = sample['image']
-    c1, c2, c3, c4 = model.backbone.get_features(img[None, :, :, :])
-
-    sizes.append(img.shape[1:3])
-    sizes.append(c1.shape[2:4])
-    sizes.append(c2.shape[2:4])
-    sizes.append(c3.shape[2:4])
-    sizes.append(c4.shape[2:4])
-
-    model = MainModel(size=sizes, same_size_output=True)
+    # the FPN head sizes itself from the feature maps, no probe pass needed
+    model = MainModel(same_size_output=True)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=10e-3)
 
@@ -28,6 +17,7 @@ if __name__ == '__main__':
     else:
         device = 'cpu'
 
-    Trainer = Trainer(model, dataset, optimizer, device=device, batch_size=1)
+    trainer = Trainer(model, dataset, optimizer, device=device, batch_size=1, num_workers=2,
+                      channels_last=True, checkpoint_path='checkpoints', log_path='train.log')
 
-    Trainer.training(5)
+    trainer.fit(5)